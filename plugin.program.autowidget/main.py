@@ -10,3 +10,4 @@ if __name__ == "__main__":
 
     with utils.timing(_params):
         router.dispatch(_handle, _params)
+    utils.flush_log()
@@ -13,6 +13,7 @@ from resources.lib import manage
 from resources.lib import refresh
 from resources.lib.common import settings
 from resources.lib.common import utils
+from resources.lib.common.registry import registry
 
 _addon_data = settings.get_addon_info("profile")
 
@@ -218,7 +219,8 @@ def add_group(target, group_name=""):
             "sort_order": "{}".format(int(manage.highest_group_sort_order()) + 1),
         }
 
-        utils.write_json(filename, group_def)
+        if utils.write_json(filename, group_def):
+            registry.saved(os.path.basename(filename), group_def)
     else:
         dialog.notification("AutoWidget", utils.get_string(30023))
 
@@ -7,7 +7,9 @@ import zipfile
 
 import six
 
+from resources.lib import manage
 from resources.lib.common import settings
+from resources.lib.common import store
 from resources.lib.common import utils
 
 _addon_data = settings.get_addon_info("profile")
@@ -17,7 +19,7 @@ _choices = [
     (".group", utils.get_string(30153), utils.get_string(30154)),
     (".widget", utils.get_string(30155), utils.get_string(30156)),
     (
-        (".cache", ".history", ".queue", ".time"),
+        (".cache", ".history", ".meta", ".queue", ".time"),
         utils.get_string(30157),
         utils.get_string(30158),
     ),
@@ -60,12 +62,11 @@ def backup():
         files = [
             x
             for x in xbmcvfs.listdir(_addon_data)[1]
-            if any(
-                x.endswith(i)
-                for i in [".group", ".widget", ".history", ".cache", ".log", ".xml"]
-            )
+            if any(x.endswith(i) for i in [".group", ".widget", ".log", ".xml"])
         ]
-        if len(files) == 0:
+        # cached data comes from the store, as it may be kept in a database
+        cached = list(store.get_store().export_files())
+        if len(files) + len(cached) == 0:
             dialog.notification("AutoWidget", utils.get_string(30045))
             del dialog
             return
@@ -76,11 +77,16 @@ def backup():
             _backup_location, "{}.zip".format(filename.replace(".zip", ""))
         )
         content = six.BytesIO()
+        total = len(files) + len(cached)
         with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as z:
             for idx, file in enumerate(files):
-                backup_dialog.update(int(idx / len(files) * 100))
+                backup_dialog.update(int(idx / total * 100))
                 with xbmcvfs.File(os.path.join(_addon_data, file)) as f:
-                    z.writestr(file, six.ensure_text(f.read()))
+                    z.writestr(file, bytes(f.readBytes()))
+            for idx, (file, data) in enumerate(cached, len(files)):
+                backup_dialog.update(int(idx / total * 100))
+                # listings may be compressed, so they're written as they are
+                z.writestr(file, data)
 
         backup_dialog.close()
         del backup_dialog
@@ -134,14 +140,18 @@ def restore():
                     restore_progress.create(
                         utils.get_string(30069), utils.get_string(30161)
                     )
+                    # the database and locks are in use by the service, so
+                    # cached data is cleared through the store instead
                     files = [
                         x
                         for x in xbmcvfs.listdir(_addon_data)[1]
-                        if not x.endswith(".log")
+                        if not x.endswith((".log", ".lock"))
+                        and not x.startswith("cache.db")
                     ]
                     for idx, file in enumerate(files):
                         restore_progress.update(int(idx / len(files) * 100))
                         utils.remove_file(os.path.join(_addon_data, file))
+                    store.get_store().clear()
                     restore_progress.close()
 
                 restore_progress.create(
@@ -170,6 +180,10 @@ def restore():
                 restore_progress.close()
                 del restore_progress
                 utils.wipe(temp_path, True)
+                # the backup may predate the current layout
+                manage.migrate(force=True)
+                store.get_store().import_files()
+                store.reopen()
                 dialog.notification("AutoWidget", utils.get_string(30164))
             else:
                 dialog.notification("AutoWidget", utils.get_string(30077))
@@ -1,8 +1,8 @@
 import threading
 import xbmcgui
 import xbmcvfs
-import xbmc
 
+import collections
 import glob
 import hashlib
 import json
@@ -15,14 +15,119 @@ import six
 
 from resources.lib import manage
 from resources.lib.common import settings
+from resources.lib.common import store
 from resources.lib.common import utils
 
 _addon_data = settings.get_addon_info("profile")
 
-_playback_history_path = os.path.join(_addon_data, "cache.history")
-
 _startup_time = time.time()  # TODO: could get reloaded so not accurate?
 DEFAULT_CACHE_TIME = 60 * 5
+HOT_CACHE_SIZE = 16 * 1024 * 1024
+
+_hot_property = "autowidget-hot-{}"
+_hot_cache = None
+
+# Fetches hold one of these lock files, picked by path hash, so a fixed set of
+# files covers every path
+_fetch_lock = os.path.join(_addon_data, "locks", "fetch-{}.lock")
+_fetch_locks = 64
+
+# Refresh requests from plugin invocations wait here, one JSON list per line,
+# for the service to take them
+_spool_path = os.path.join(_addon_data, "queue.spool")
+_spool_lock = os.path.join(_addon_data, "locks", "queue.spool.lock")
+
+
+class HotCache(object):
+    """Bounded LRU of recently fetched listings, owned by the service.
+
+    Listings are published as home window properties, which every Python
+    invoker in the same Kodi process can read, along with the stamp of the
+    stored listing they were serialized from. Plugin invocations use them
+    instead of reading and parsing the listing from disk as long as the stamp
+    still matches. Those reads happen outside the service, so recency comes
+    from the `last_read` they record in each path's metadata.
+    """
+
+    def __init__(self, max_bytes=HOT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, hash, cache_json, info):
+        with self._lock:
+            self._discard(hash)
+            if len(cache_json) > self.max_bytes:
+                return
+            utils.set_property(_hot_property.format(hash), cache_json)
+            utils.set_property(
+                _hot_property.format(hash) + "-stamp", _format_stamp(info)
+            )
+            self._entries[hash] = len(cache_json)
+            self.size += len(cache_json)
+            if self.size <= self.max_bytes:
+                return
+            hashes = list(self._entries)
+
+        # least recently read first, keeping the listing just put for last
+        _store = store.get_store()
+        hashes.sort(
+            key=lambda h: (h == hash, (_store.read_meta(h) or {}).get("last_read") or 0)
+        )
+        with self._lock:
+            for victim in hashes:
+                if self.size <= self.max_bytes:
+                    break
+                self._discard(victim)
+
+    def remove(self, hash):
+        with self._lock:
+            self._discard(hash)
+
+    def _discard(self, hash):
+        size = self._entries.pop(hash, None)
+        if size is not None:
+            self.size -= size
+            utils.clear_property(_hot_property.format(hash))
+            utils.clear_property(_hot_property.format(hash) + "-stamp")
+
+    def clear(self):
+        with self._lock:
+            for hash in list(self._entries):
+                self._discard(hash)
+
+    def stats(self):
+        return "{} listings, {}B, {} hits, {} misses".format(
+            len(self._entries),
+            self.size,
+            utils.get_counter("hot-hits"),
+            utils.get_counter("hot-misses"),
+        )
+
+
+def enable_hot_cache(max_bytes=HOT_CACHE_SIZE):
+    global _hot_cache
+    _hot_cache = HotCache(max_bytes)
+    return _hot_cache
+
+
+def _format_stamp(info):
+    return "{:.6f}-{}".format(*info)
+
+
+def read_hot_listing(hash, info):
+    """Returns the listing published by the service for `hash`, provided it
+    was serialized from the stored listing with the given modified time and
+    size."""
+    prop = _hot_property.format(hash)
+    if utils.get_property(prop + "-stamp") == _format_stamp(info):
+        cache_json = utils.get_property(prop)
+        if cache_json:
+            utils.increment_counter("hot-hits")
+            return utils.convert(json.loads(cache_json))
+    utils.increment_counter("hot-misses")
+    return None
 
 
 def clear_cache(target=None):
@@ -36,14 +141,139 @@ def clear_cache(target=None):
                 i
                 for j in xbmcvfs.listdir(_addon_data)
                 for i in j
-                if i.endswith((".cache", ".history", ".queue", ".time"))
+                if i.endswith((".cache", ".history", ".meta", ".queue", ".time"))
             ]:
                 utils.remove_file(os.path.join(_addon_data, file))
+            store.get_store().clear()
     else:
-        utils.remove_file(os.path.join(_addon_data, "{}.cache".format(target)))
+        store.get_store().remove_listing(target)
+        utils.clear_property(_hot_property.format(target) + "-stamp")
         utils.update_container(True)
 
 
+def compression_report():
+    """Compares how the available codecs do on the listings currently in the
+    cache, by size and by time taken to encode and decode them."""
+    _store = store.get_store()
+    listings = []
+    for hash in _store.listing_hashes():
+        contents = _store.read_listing(hash)
+        if contents is not None:
+            listings.append(contents)
+
+    dialog = xbmcgui.Dialog()
+    if not listings:
+        dialog.notification("AutoWidget", utils.get_string(30178))
+        del dialog
+        return
+
+    current = store.listing_codec()
+    candidates = [(None, 0), ("json", 0)] + [
+        (codec, level) for codec in ["zlib", "gzip"] for level in [1, 6, 9]
+    ]
+    if current not in candidates:
+        candidates.append(current)
+
+    rows = []
+    baseline = None
+    for codec, level in candidates:
+        size = 0
+        write_time = 0
+        read_time = 0
+        for contents in listings:
+            start = time.time()
+            data = utils.encode_json(contents, codec=codec, level=level)
+            write_time += time.time() - start
+
+            start = time.time()
+            utils.decode_json(data)
+            read_time += time.time() - start
+            size += len(data)
+        if baseline is None:
+            baseline = size
+
+        label = codec or "indented"
+        if codec in ["zlib", "gzip"]:
+            label = "{}-{}".format(codec, level)
+        rows.append(
+            "{}{:<10} {:>10}B {:>6.1f}%   write {:>8.1f}ms   read {:>8.1f}ms".format(
+                "*" if (codec, level) == current else " ",
+                label,
+                size,
+                size * 100.0 / baseline,
+                write_time * 1000,
+                read_time * 1000,
+            )
+        )
+        utils.log("Compression report: {}".format(rows[-1]), "info")
+
+    summary = utils.get_string(30177).format(
+        len(listings),
+        current[0] if current[0] == "json" else "{}-{}".format(*current),
+    )
+    dialog.textviewer(utils.get_string(30176), "\n".join([summary, ""] + rows))
+    del dialog
+
+
+def collect_garbage(max_age=None, max_size=None):
+    """Evicts paths that haven't been read for `max_age` days, then the least
+    recently read ones until the cache fits in `max_size` MB. Widgets which no
+    longer exist are dropped from each path, along with any path left with no
+    widgets at all."""
+    if max_age is None:
+        max_age = settings.get_setting_int("cache.max_age")
+    if max_size is None:
+        max_size = settings.get_setting_int("cache.max_size")
+    cutoff = time.time() - max_age * 24 * 60 * 60
+    budget = max_size * 1024 * 1024
+
+    _store = store.get_store()
+    known = set(widget_def["id"] for widget_def in manage.find_defined_widgets())
+
+    removed = 0
+    reclaimed = 0
+    kept = []
+    for hash, last_read, size, widgets in _store.entries():
+        widgets = [i for i in widgets if i]
+        unknown = [i for i in widgets if i not in known]
+        if last_read < cutoff or (widgets and len(unknown) == len(widgets)):
+            _evict(_store, hash)
+            removed += 1
+            reclaimed += size
+        else:
+            if unknown:
+                _store.remove_widgets(hash, unknown)
+            kept.append((last_read, size, hash))
+
+    total = sum(size for _, size, _ in kept)
+    kept.sort()
+    while kept and total > budget:
+        last_read, size, hash = kept.pop(0)
+        _evict(_store, hash)
+        removed += 1
+        reclaimed += size
+        total -= size
+
+    plays = _store.trim_plays(cutoff)
+    if removed:
+        _store.compact()
+
+    utils.log(
+        "Cache cleanup removed {} paths ({}B), {} old plays; {} paths ({}B) kept".format(
+            removed, reclaimed, plays, len(kept), total
+        ),
+        "notice",
+    )
+    return removed, reclaimed
+
+
+def _evict(_store, hash):
+    with _store.lock(hash):
+        _store.remove(hash)
+    if _hot_cache is not None:
+        _hot_cache.remove(hash)
+
+
 def hash_from_cache_path(path):
     base = os.path.basename(path)
     return os.path.splitext(base)[0]
@@ -51,44 +281,63 @@ def hash_from_cache_path(path):
 
 def read_history(path, create_if_missing=True):
     hash = path2hash(path)
-    history_path = os.path.join(_addon_data, "{}.history".format(hash))
-    if not xbmcvfs.exists(history_path):
-        if create_if_missing:
-            cache_data = dict(history=[], widgets=[])
-            utils.write_json(history_path, cache_data)
-        else:
-            cache_data = None
-    else:
-        cache_data = utils.read_json(history_path, default=dict(history=[], widgets=[]))
+    cache_data = store.get_store().read_history(hash)
+    if cache_data is None and create_if_missing:
+        cache_data = dict(history=[], widgets=[])
+        store.get_store().save_history(hash, cache_data)
     return cache_data
 
 
-def push_cache_queue(path, widget_id=None):
+def push_cache_queue(path, widget_id=None, reason="expired", chance=None):
+    """Asks the service to refresh `path`. `reason` is one of "missing" (a
+    holding tile is showing in its place), "expired", "precache" (a next page
+    that isn't showing yet) or "playback" (it may have changed after something
+    was watched, with probability `chance`), and is used to prioritise the
+    request."""
     hash = path2hash(path)
-    history = read_history(path, create_if_missing=True)  # Ensure its created
-    changed = False
-    if widget_id is not None and widget_id not in history["widgets"]:
-        history["widgets"].append(widget_id)
-        changed = True
-    if history.get("path", "") != path:
-        history["path"] = path
-        changed = True
-    if changed:
-        history_path = os.path.join(_addon_data, "{}.history".format(hash))
-        utils.write_json(history_path, history)
-
-    command = {'jsonrpc': '2.0', 'method': 'JSONRPC.NotifyAll',
-                'params': {'sender': "AutoWidget",
-                    'message': "queue",
-                    'data': (hash, path, widget_id),
-                },
-                'id': 1,}
-    def send():
-        while not utils.call_jsonrpc(command):
-            xbmc.sleep(1000) # Wait untl service starts
-    # Don't wait in case service hasn't started
-    # TODO: check this doesn't still block until thread finishes
-    threading.Thread(target=send).start()
+    _store = store.get_store()
+    with _store.lock(hash):
+        history = read_history(path, create_if_missing=True)  # Ensure its created
+        changed = False
+        if widget_id is not None and widget_id not in history["widgets"]:
+            history["widgets"].append(widget_id)
+            changed = True
+        if history.get("path", "") != path:
+            history["path"] = path
+            changed = True
+        if changed:
+            _store.save_history(hash, history)
+
+    # Spooled rather than sent, so it waits for the service if it isn't
+    # running yet and costs an append instead of a JSON-RPC round trip
+    line = json.dumps([hash, path, widget_id, reason, chance]) + "\n"
+    with utils.file_lock(_spool_lock):
+        with open(utils.translatePath(_spool_path), "a") as f:
+            f.write(line)
+
+
+def take_cache_queue():
+    """Returns the refresh requests spooled since the last call, oldest first,
+    as `(hash, path, widget_id, reason, chance)`, and the file they were read
+    from. The spool is moved aside under its lock before being read, so each
+    request is taken once. The caller removes the file once the requests are
+    safely queued; until then the next call returns them again."""
+    spool = utils.translatePath(_spool_path)
+    taken = spool + ".taken"
+    if not os.path.exists(taken):
+        if not os.path.exists(spool):
+            return [], None
+        with utils.file_lock(_spool_lock):
+            os.rename(spool, taken)
+
+    requests = []
+    with open(taken) as f:
+        for line in f:
+            try:
+                requests.append(tuple(json.loads(line)))
+            except ValueError:
+                utils.log("Skipping damaged queue request: {!r}", "error", line)
+    return requests, taken
 
 
 def path2hash(path):
@@ -100,8 +349,7 @@ def path2hash(path):
 
 def widgets_for_path(path):
     hash = path2hash(path)
-    history_path = os.path.join(_addon_data, "{}.history".format(hash))
-    cache_data = utils.read_json(history_path) if os.path.exists(history_path) else None
+    cache_data = store.get_store().read_history(hash)
     if cache_data is None:
         cache_data = {}
     widgets = cache_data.setdefault("widgets", [])
@@ -134,6 +382,44 @@ def cache_and_update(path, widget_id, cache_data, notify=None):
 
 
 def cache_files(path, widget_id):
+    """Fetches `path` into the cache. Fetches are single-flight: whoever asks
+    for a path while another thread or process is fetching it waits for that
+    fetch and shares its result instead of fetching again. Only the fetch that
+    ran reports a change, so widgets aren't updated twice for it."""
+    hash = path2hash(path)
+    asked = time.time()
+    lock = _fetch_lock.format(int(hash[:4], 16) % _fetch_locks)
+    with utils.file_lock(lock):
+        _store = store.get_store()
+        meta = _store.read_meta(hash)
+        if meta and (meta.get("fetched") or 0) >= asked:
+            files = _store.read_listing(hash)
+            if files is not None:
+                utils.increment_counter("fetches-avoided")
+                utils.log("Shared fetch of {}", "debug", hash[:5])
+                _record_widget(path, hash, widget_id)
+                return files, False
+        return _fetch(path, widget_id)
+
+
+def _record_widget(path, hash, widget_id):
+    if widget_id is None:
+        return
+    _store = store.get_store()
+    with _store.lock(hash):
+        cache_data = _store.read_history(hash) or dict(history=[], widgets=[])
+        if widget_id in cache_data["widgets"]:
+            return
+        cache_data["widgets"].append(widget_id)
+        cache_data["path"] = path
+        _store.save_history(hash, cache_data)
+        meta = _store.read_meta(hash)
+        if meta is not None and widget_id not in meta.setdefault("widgets", []):
+            meta["widgets"].append(widget_id)
+            _store.write_meta(hash, meta)
+
+
+def _fetch(path, widget_id):
     info_keys = utils.get_info_keys()
     params = {
         "jsonrpc": "2.0",
@@ -149,101 +435,224 @@ def cache_files(path, widget_id):
     return (files, changed)
 
 
-def cache_expiry(path, widget_id, add=None, background=True):
+def cache_expiry(path, widget_id, add=None, background=True, load=True):
     # Predict how long to cache for with a min of 5min so updates don't go in a loop
     # TODO: find better way to prevents loops so that users trying to manually refresh can do so
-    # TODO: manage the cache files to remove any too old or no longer used
-    # TODO: update paths on autowidget refresh based on predicted update frequency. e.g. plugins with random paths should
-    # update when autowidget updates.
+    # The service refreshes recently read paths just ahead of the expiry predicted
+    # here, so most reads should find them fresh.
     hash = path2hash(path)
-    cache_path = os.path.join(_addon_data, "{}.cache".format(hash))
-
-    # Read file every time as we might be called from multiple processes
-    history_path = os.path.join(_addon_data, "{}.history".format(hash))
-    cache_data = utils.read_json(history_path) if xbmcvfs.exists(history_path) else None
-    if cache_data is None:
-        cache_data = {}
-        since_read = 0
-    else:
-        since_read = time.time() - last_read(hash)
-
-    history = cache_data.setdefault("history", [])
-    widgets = cache_data.setdefault("widgets", [])
-    if widget_id not in widgets:
-        widgets.append(widget_id)
-
+    if add is not None:
+        return _write_expiry(path, hash, widget_id, add)
+
+    _store = store.get_store()
+    with _store.lock(hash):
+        # Read every time as we might be called from multiple processes
+        meta = _store.read_meta(hash)
+        if meta is not None:
+            since_read = _touch_meta(path, hash, widget_id, meta)
+        else:
+            cache_data = _store.read_history(hash)
+            if cache_data is None:
+                cache_data = {}
+                since_read = 0
+            else:
+                since_read = time.time() - last_read(hash)
+            history = cache_data.setdefault("history", [])
+            widgets = cache_data.setdefault("widgets", [])
+            if widget_id not in widgets:
+                widgets.append(widget_id)
+            # write any updated widget_ids so we know what to update when we dequeue
+            # Also important as wwe use last modified of .history as accessed time
+            _store.save_history(hash, cache_data)
+            info = _store.listing_info(hash)
+    if meta is not None:
+        return _read_meta_expiry(path, hash, meta, since_read, background, load)
+
+    # a page only being precached isn't on screen, so it waits behind those that are
+    reason = None if load else "precache"
     expiry = time.time() - 20
     contents = None
     changed = True
     size = 0
-
-    if add is not None:
-        cache_json = json.dumps(add)
-        if not add or not cache_json.strip():
-            result = "Invalid Write"
-
-        elif "error" in add or not add.get("result", {}).get("files"):
-            # In this case we don't want to cache a bad result
-            result = "Error"
-            # TODO: do we schedule a new update? or put dummy content up even if we have
-            # good cached content?
-        else:
-            utils.write_json(cache_path, add)
-            contents = add
-            size = len(cache_json)
-            content_hash = path2hash(cache_json)
-            changed = history[-1][1] != content_hash if history else True
-            history.append((time.time(), content_hash))
-            if cache_data.get("path") != path:
-                cache_data["path"] = path
-            utils.write_json(history_path, cache_data)
-            # expiry = history[-1][0] + DEFAULT_CACHE_TIME
-            pred_dur = predict_update_frequency(history)
-            expiry = (
-                history[-1][0] + pred_dur * 0.75
-            )  # less than prediction to ensure pred keeps up to date
-            result = "Wrote"
+    if info is None:
+        result = "Empty"
+        if background:
+            contents = utils.make_holding_path(utils.get_string(30143), "refresh")
+            push_cache_queue(path, reason=reason or "missing")
     else:
-        # write any updated widget_ids so we know what to update when we dequeue
-        # Also important as wwe use last modified of .history as accessed time
-        utils.write_json(history_path, cache_data)
-        if not xbmcvfs.exists(cache_path):
-            result = "Empty"
+        size = info[1]
+        contents = _store.read_listing(hash, log_file=True)
+        if contents is None:
+            result = "Invalid Read"
             if background:
-                contents = utils.make_holding_path(utils.get_string(30143), "refresh")
-                push_cache_queue(path)
+                contents = utils.make_holding_path(
+                    utils.get_string(30137).format(hash), "alert"
+                )
+                push_cache_queue(path, reason=reason or "missing")
         else:
-            contents = utils.read_json(cache_path, log_file=True)
-            if contents is None:
-                result = "Invalid Read"
-                if background:
-                    contents = utils.make_holding_path(
-                        utils.get_string(30137).format(hash), "alert"
+            if history:
+                expiry = history[-1][1] + predict_update_frequency(history)
+
+            # Written before metadata existed, so record it now to make later
+            # reads cheap, unless a refresh got there first
+            with _store.lock(hash):
+                if _store.read_meta(hash) is None:
+                    _store.write_meta(
+                        hash,
+                        {
+                            "size": size,
+                            "content_hash": history[-1][2] if history else None,
+                            "fetched": history[-1][1] if history else info[0],
+                            "expiry": expiry,
+                            "last_read": time.time(),
+                            "widgets": widgets,
+                        },
                     )
-                    push_cache_queue(path)
+
+            #                queue_len = len(list(iter_queue()))
+            if expiry > time.time():
+                result = "Read"
+            elif not background:
+                result = "Skip already updated"
+            # elif queue_len > 3:
+            #     # Try to give system more breathing space by returning empty cache but ensuring refresh
+            #     # better way is to just do this the first X accessed after startup.
+            #     # or how many accessed in the last 30s?
+            #     push_cache_queue(hash)
+            #     result = "Skip (queue={})".format(queue_len)
+            #     contents = dict(result=dict(files=[]))
             else:
-                size = len(json.dumps(contents))
-                if history:
-                    expiry = history[-1][0] + predict_update_frequency(history)
-
-                #                queue_len = len(list(iter_queue()))
-                if expiry > time.time():
-                    result = "Read"
-                elif not background:
-                    result = "Skip already updated"
-                # elif queue_len > 3:
-                #     # Try to give system more breathing space by returning empty cache but ensuring refresh
-                #     # better way is to just do this the first X accessed after startup.
-                #     # or how many accessed in the last 30s?
-                #     push_cache_queue(hash)
-                #     result = "Skip (queue={})".format(queue_len)
-                #     contents = dict(result=dict(files=[]))
-                else:
-                    push_cache_queue(path)
-                    result = "Read and queue"
+                push_cache_queue(path, reason=reason or "expired")
+                result = "Read and queue"
+    _log_expiry(result, size, expiry, since_read, hash, widgets)
+    return expiry, contents, changed
+
+
+def _write_expiry(path, hash, widget_id, add):
+    """Stores a fetched listing and predicts when it will next change. The
+    listing is encoded and written first; the path's lock is only held to
+    update its history and metadata."""
+    _store = store.get_store()
+    expiry = time.time() - 20
+    cache_json = json.dumps(add)
+    if not add or not cache_json.strip():
+        result = "Invalid Write"
+    elif "error" in add or not add.get("result", {}).get("files"):
+        # In this case we don't want to cache a bad result
+        result = "Error"
+        # TODO: do we schedule a new update? or put dummy content up even if we have
+        # good cached content?
+    else:
+        result = "Wrote"
+    if result != "Wrote":
+        cache_data = _store.read_history(hash) or {}
+        since_read = time.time() - last_read(hash) if cache_data else 0
+        widgets = cache_data.get("widgets", [])
+        _log_expiry(result, 0, expiry, since_read, hash, widgets)
+        return expiry, None, True
+
+    fetched = time.time()
+    _store.write_listing(hash, add)
+    size = len(cache_json)
+    content_hash = path2hash(cache_json)
+    with _store.lock(hash):
+        cache_data = _store.read_history(hash)
+        if cache_data is None:
+            cache_data = {}
+            since_read = 0
+        else:
+            since_read = time.time() - last_read(hash)
+        history = cache_data.setdefault("history", [])
+        widgets = cache_data.setdefault("widgets", [])
+        if widget_id not in widgets:
+            widgets.append(widget_id)
+        meta = _store.read_meta(hash) or {"last_read": _store.last_read(hash)}
+        changed = history[-1][2] != content_hash if history else True
+        store.append_history(history, fetched, content_hash)
+        cache_data["path"] = path
+        _store.save_history(hash, cache_data, with_history=True)
+        # expiry = history[-1][1] + DEFAULT_CACHE_TIME
+        pred_dur = predict_update_frequency(history)
+        expiry = (
+            history[-1][1] + pred_dur * 0.75
+        )  # less than prediction to ensure pred keeps up to date
+
+        meta.update(
+            size=size,
+            content_hash=content_hash,
+            fetched=fetched,
+            expiry=history[-1][1] + pred_dur,
+            widgets=widgets,
+        )
+        _store.write_meta(hash, meta)
+    if _hot_cache is not None:
+        _hot_cache.put(hash, cache_json, (fetched, size))
+    _log_expiry(result, size, expiry, since_read, hash, widgets)
+    return expiry, add, changed
+
+
+def _touch_meta(path, hash, widget_id, meta):
+    """Records the read and the reading widget. Returns the seconds since the
+    previous read."""
+    _store = store.get_store()
+    now = time.time()
+    since_read = now - meta.get("last_read", 0)
+    widgets = meta.setdefault("widgets", [])
+    if widget_id not in widgets:
+        # write any updated widget_ids so we know what to update when we dequeue
+        cache_data = _store.read_history(hash) or dict(history=[], widgets=[])
+        if widget_id not in cache_data["widgets"]:
+            cache_data["widgets"].append(widget_id)
+        cache_data["path"] = path
+        _store.save_history(hash, cache_data)
+        widgets.append(widget_id)
+    meta["last_read"] = now
+    _store.write_meta(hash, meta)
+    return since_read
+
+
+def _read_meta_expiry(path, hash, meta, since_read, background, load):
+    """Decides freshness from the metadata record alone. The listing itself is
+    only loaded when `load` is set, i.e. when it's about to be rendered."""
+    _store = store.get_store()
+    now = time.time()
+    widgets = meta["widgets"]
+    expiry = meta.get("expiry", 0)
+    size = meta.get("size", 0)
+    contents = None
+    if load:
+        contents = read_hot_listing(hash, (meta.get("fetched", 0), size))
+        if contents is None:
+            contents = _store.read_listing(hash, log_file=True)
+
+    if load and contents is None:
+        result = "Invalid Read"
+        _store.remove_listing(hash)
+        if background:
+            contents = utils.make_holding_path(
+                utils.get_string(30137).format(hash), "alert"
+            )
+            push_cache_queue(path, reason="missing")
+    elif expiry > now:
+        result = "Read"
+    elif not background:
+        result = "Skip already updated"
+    else:
+        push_cache_queue(path, reason="expired" if load else "precache")
+        result = "Read and queue"
+
+    _log_expiry(result, size, expiry, since_read, hash, widgets)
+    return expiry, contents, True
+
+
+def _log_expiry(result, size, expiry, since_read, hash, widgets):
     # TODO: some metric that tells us how long to the first and last widgets becomes visible and then get updated
     # not how to measure the time delay when when the cache is read until it appears on screen?
     # Is the first cache read always the top visibible widget?
+    if result == "Read":
+        utils.increment_counter("reads-fresh")
+    elif result == "Read and queue":
+        utils.increment_counter("reads-stale")
     utils.log(
         "{} cache {}B (exp:{}, last:{}): {} {}".format(
             result,
@@ -255,35 +664,41 @@ def cache_expiry(path, widget_id, add=None, background=True):
         ),
         "notice",
     )
-    return expiry, contents, changed
 
 
 def last_read(hash):
     # Technically this is last read or updated but we can change it to be last read Later
     # if we create another file
-    path = os.path.join(_addon_data, "{}.history".format(hash))
-    return xbmcvfs.Stat(path).st_mtime()
+    return store.get_store().last_read(hash)
 
 
 def predict_update_frequency(history):
+    """Takes history compacted into `[first_seen, last_seen, content_hash, count]`
+    segments. Each segment stands for `count` fetches of the same content, so
+    this gives the same answer as walking every fetch individually."""
     if not history:
         return DEFAULT_CACHE_TIME
     update_count = 0
     duration = 0
     changes = []
-    last_when, last = history[0]
-    for when, content in history[1:]:
-        update_count += 1
-        if content == last:
-            duration += when - last_when
-        else:
-            duration = (
-                +(when - last_when) / 2
-            )  # change could have happened any time inbetween
-            changes.append((duration, update_count))
-            duration = 0
-            update_count = 0
-        last_when = when
+    last_when = history[0][0]
+    last = history[0][2]
+    for idx, (first_seen, last_seen, content, count) in enumerate(history):
+        if idx > 0:
+            update_count += 1
+            if content == last:
+                duration += first_seen - last_when
+            else:
+                duration = (
+                    +(first_seen - last_when) / 2
+                )  # change could have happened any time inbetween
+                changes.append((duration, update_count))
+                duration = 0
+                update_count = 0
+        # the rest of the run is unchanged
+        update_count += count - 1
+        duration += last_seen - first_seen
+        last_when = last_seen
         last = content
     if not changes and duration:
         # drop the last part of the history that hasn't changed yet unless we have no other history to work with
@@ -307,10 +722,13 @@ def predict_update_frequency(history):
     ones = len([c for d, c in changes if c == 1]) / float(len(changes))
     # TODO: if many streaks with lots of counts then its stable and can predict
     utils.log(
-        "avg_dur {:0.0f}s, med_dur {:0.0f}s, weighted {:0.0f}s, ones {:0.2f}, all {}".format(
-            avg_dur, med_dur, weighted, ones, changes
-        ),
+        "avg_dur {:0.0f}s, med_dur {:0.0f}s, weighted {:0.0f}s, ones {:0.2f}, all {}",
         "debug",
+        avg_dur,
+        med_dur,
+        weighted,
+        ones,
+        changes,
     )
     if ones > 0.9:
         # too unstable so no point guessing
@@ -331,28 +749,24 @@ def widgets_changed_by_watching(media_type):
     # Predict which widgets the skin might have that could have changed based on recently finish
     # watching something
 
-    all_hist = [
-        os.path.join(_addon_data, x)
-        for x in xbmcvfs.listdir(_addon_data)[1]
-        if x.endswith(".history")
-    ]
+    _store = store.get_store()
 
     # Get rid of ones not read this session. These are old
-    all_hist = [hist_path for hist_path in all_hist if (xbmcvfs.Stat(hist_path).st_mtime() - _startup_time) >= 0]
+    all_hist = list(_store.histories(since=_startup_time))
 
     # Simple version. Anything updated recently (since startup?)
     # priority = sorted(all_cache, key=os.path.getmtime)
     # Sort by chance of it updating
-    plays = utils.read_json(_playback_history_path, default={}).setdefault("plays", [])
+    plays = _store.read_plays()
     plays_for_type = [(time, t) for time, t in plays if t == media_type or media_type is None]
     priority = sorted(
         [
             (
                 chance_playback_updates_widget(cache_data, plays_for_type),
                 cache_data.get("path", ""),
-                hist_path,
+                hist_hash,
             )
-            for hist_path, cache_data in [(p, utils.read_json(p, default={})) for p in all_hist]
+            for hist_hash, cache_data in all_hist
         ],
         reverse=True,
     )
@@ -360,7 +774,7 @@ def widgets_changed_by_watching(media_type):
     count_prob_changed = 0
     randoms = 0
     i = 0
-    for chance, path, history_path in priority:
+    for chance, path, hist_hash in priority:
         hash = path2hash(path)
         if "page=" in path:
             # HACK: must be a better way
@@ -371,19 +785,28 @@ def widgets_changed_by_watching(media_type):
                 "notice",
             )
             count_prob_changed += 1
-            yield hash, path
+            yield hash, path, chance
         elif random.random() <= (1/len(priority)):
             # If widgets never get updated after playback we never get to know if they change after playback. So always pick some randomly
             utils.log("Queue random {:.2f}% {} {}".format(chance * 100, hash[:5], path), 'notice')
             randoms += 1
-            yield hash, path
+            yield hash, path, chance
         else:
             utils.log("Prob not changes due to playback {:.2f}% {} {}".format(chance * 100, hash[:5], path), 'notice')
         i += 1
     utils.log("=== End Widget update: {} prob changed after playback {} randoms".format(count_prob_changed, randoms), 'notice')
 
+def _history_endpoints(history):
+    # Fetches in the middle of a run have the same content as its first and last
+    # fetch, so they never change which update a playback is compared against.
+    for first_seen, last_seen, content, count in history:
+        yield [first_seen, content]
+        if count > 1 and last_seen != first_seen:
+            yield [last_seen, content]
+
+
 def chance_playback_updates_widget(cache_data, plays, cutoff_time=60 * 60):
-    history = cache_data.setdefault("history", [])
+    history = list(_history_endpoints(cache_data.get("history", [])))
     hist_len = len(history)
     path = cache_data.get("path", "")
     # Complex version
@@ -449,10 +872,16 @@ def chance_playback_updates_widget(cache_data, plays, cutoff_time=60 * 60):
         prob = (prob * datapoints + 0.5 * unknown_weight) / (datapoints + unknown_weight)
 
     utils.log(
-        "prob:{:.2f}% changes:{} non_changes:{} non_play_changes:{} too_late:{} plays:{} hist:{}: {}".format(
-            prob*100, changes, non_changes, unrelated_changes, too_late_changes, len(plays), hist_len, path,
-        ),
-        "notice",
+        "prob:{:.2f}% changes:{} non_changes:{} non_play_changes:{} too_late:{} plays:{} hist:{}: {}",
+        "debug",
+        prob * 100,
+        changes,
+        non_changes,
+        unrelated_changes,
+        too_late_changes,
+        len(plays),
+        hist_len,
+        path,
     )
     return prob
 
@@ -461,7 +890,4 @@ def save_playback_history(media_type, playback_percentage, path):
     # Record in json when things got played to help predict which widgets will change after playback
     # if playback_percentage < 0.7:
     #    return
-    history = utils.read_json(_playback_history_path, default={})
-    plays = history.setdefault("plays", [])
-    plays.append((time.time(), media_type))
-    utils.write_json(_playback_history_path, history)
+    store.get_store().add_play(time.time(), media_type)
@@ -0,0 +1,142 @@
+import xbmcvfs
+
+import copy
+import os
+import threading
+
+from resources.lib.common import settings
+from resources.lib.common import utils
+
+_addon_data = settings.get_addon_info("profile")
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(utils.translatePath(path))
+    except OSError:
+        return None
+    # atomic writes replace the file, so the inode changes even when the
+    # mtime resolution is too coarse to notice
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+class Registry(object):
+    """Parsed `.group` and `.widget` definitions, kept for as long as Kodi
+    reuses the Python invoker. The folder listing is only re-read when the
+    folder's mtime changes, and a file is only re-parsed when its own stat
+    does, so a warm invocation costs a stat per definition instead of a read
+    and parse. Callers get copies and are free to modify them.
+
+    Groups also feed an index from path id to the `.group` file holding it,
+    so a path can be found without parsing every group."""
+
+    def __init__(self, folder=_addon_data):
+        self.folder = folder
+        self._lock = threading.RLock()
+        self._listing = None
+        self._files = {}
+        self._paths = {}
+
+    @property
+    def warm(self):
+        return self._listing is not None
+
+    def _filenames(self):
+        key = _stat_key(self.folder)
+        if self._listing is None or key is None or self._listing[0] != key:
+            filenames = [
+                filename
+                for filename in xbmcvfs.listdir(self.folder)[1]
+                if filename.endswith((".group", ".widget"))
+            ]
+            for filename in set(self._files) - set(filenames):
+                self._forget(filename)
+            self._listing = (key, filenames)
+        return self._listing[1]
+
+    def _load(self, filename):
+        path = os.path.join(self.folder, filename)
+        key = _stat_key(path)
+        if key is None:
+            self._forget(filename)
+            return None
+        cached = self._files.get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        definition = utils.read_json(path)
+        # keyed by the stat taken before reading, so a write landing during
+        # the read leaves the entry stale rather than marking it current
+        self._remember(filename, key, definition)
+        return definition
+
+    def _remember(self, filename, key, definition):
+        self._forget(filename)
+        if key is None:
+            return
+        self._files[filename] = (key, definition)
+        if filename.endswith(".group") and definition:
+            for path_def in definition.get("paths", []):
+                self._paths[path_def.get("id")] = filename
+
+    def _forget(self, filename):
+        cached = self._files.pop(filename, None)
+        if cached is not None and filename.endswith(".group") and cached[1]:
+            for path_def in cached[1].get("paths", []):
+                if self._paths.get(path_def.get("id")) == filename:
+                    del self._paths[path_def.get("id")]
+
+    def definitions(self, ext):
+        """Returns `(filename, definition)` for each readable file ending in
+        `ext`, in folder listing order."""
+        with self._lock:
+            found = []
+            for filename in self._filenames():
+                if filename.endswith(ext):
+                    definition = self._load(filename)
+                    if definition:
+                        found.append((filename, copy.deepcopy(definition)))
+            return found
+
+    def get(self, filename):
+        """Returns a copy of the definition in `filename`, or None if there is
+        no such file."""
+        with self._lock:
+            return copy.deepcopy(self._load(filename))
+
+    def find_path(self, path_id):
+        """Returns a copy of the path definition with `path_id` from whichever
+        group holds it, or None."""
+        with self._lock:
+            for attempt in range(2):
+                filename = self._paths.get(path_id)
+                group_def = self._load(filename) if filename else None
+                for path_def in (group_def or {}).get("paths", []):
+                    if path_def.get("id") == path_id:
+                        return copy.deepcopy(path_def)
+                if attempt == 0:
+                    # not indexed yet, or moved: bring every group up to date
+                    for filename in self._filenames():
+                        if filename.endswith(".group"):
+                            self._load(filename)
+        return None
+
+    def saved(self, filename, definition):
+        """Records a definition just written to `filename`, sparing the next
+        lookup from parsing it back."""
+        with self._lock:
+            path = os.path.join(self.folder, filename)
+            self._remember(filename, _stat_key(path), copy.deepcopy(definition))
+            # the folder's mtime may not have moved on, so the listing isn't
+            # re-read
+            if self._listing is not None and filename not in self._listing[1]:
+                self._listing[1].append(filename)
+
+    def removed(self, filename):
+        with self._lock:
+            self._forget(filename)
+            if self._listing is not None and filename in self._listing[1]:
+                self._listing[1].remove(filename)
+
+
+registry = Registry()
@@ -1,8 +1,43 @@
 import xbmcaddon
 
+import functools
+
 import six
 
+# Values read during this invocation, keyed by (getter, id, addon). Cleared
+# whenever settings are written, or by the service when Kodi reports a change.
+_snapshot = {}
+
+
+def invalidate():
+    _snapshot.clear()
+
+
+def _snapshotted(func):
+    @functools.wraps(func)
+    def wrapper(_id, addon=None):
+        key = (func.__name__, _id, addon)
+        try:
+            return _snapshot[key]
+        except KeyError:
+            value = _snapshot[key] = func(_id, addon)
+            return value
+
+    return wrapper
+
+
+def _invalidating(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate()
+
+    return wrapper
+
 
+@_snapshotted
 def get_localized_string(_id, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     s = six.text_type(_addon.getLocalizedString(_id))
@@ -10,6 +45,7 @@ def get_localized_string(_id, addon=None):
     return s
 
 
+@_snapshotted
 def get_setting(setting, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     s = _addon.getSetting(setting)
@@ -17,6 +53,7 @@ def get_setting(setting, addon=None):
     return s
 
 
+@_snapshotted
 def get_setting_bool(setting, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -27,6 +64,7 @@ def get_setting_bool(setting, addon=None):
     return s
 
 
+@_snapshotted
 def get_setting_int(setting, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -37,6 +75,7 @@ def get_setting_int(setting, addon=None):
     return s
 
 
+@_snapshotted
 def get_setting_float(setting, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -47,6 +86,7 @@ def get_setting_float(setting, addon=None):
     return s
 
 
+@_snapshotted
 def get_setting_string(setting, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -57,6 +97,7 @@ def get_setting_string(setting, addon=None):
     return s
 
 
+@_invalidating
 def set_setting(setting, value, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     s = _addon.setSetting(setting, value)
@@ -64,6 +105,7 @@ def set_setting(setting, value, addon=None):
     return s
 
 
+@_invalidating
 def set_setting_bool(setting, value, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -74,6 +116,7 @@ def set_setting_bool(setting, value, addon=None):
     return s
 
 
+@_invalidating
 def set_setting_int(setting, value, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -84,6 +127,7 @@ def set_setting_int(setting, value, addon=None):
     return s
 
 
+@_invalidating
 def set_setting_float(setting, value, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -94,6 +138,7 @@ def set_setting_float(setting, value, addon=None):
     return s
 
 
+@_invalidating
 def set_setting_string(setting, value, addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     try:
@@ -104,6 +149,7 @@ def set_setting_string(setting, value, addon=None):
     return s
 
 
+@_invalidating
 def open_settings(addon=None):
     _addon = xbmcaddon.Addon() if not addon else xbmcaddon.Addon(addon)
     s = _addon.openSettings()
@@ -111,6 +157,7 @@ def open_settings(addon=None):
     return s
 
 
+@_snapshotted
 def get_addon_info(label, addon=None):
     s = ""
     try:
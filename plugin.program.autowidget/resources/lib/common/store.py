@@ -0,0 +1,638 @@
+import xbmcvfs
+
+import contextlib
+import os
+import threading
+import time
+import zlib
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from resources.lib.common import settings
+from resources.lib.common import utils
+
+_addon_data = settings.get_addon_info("profile")
+
+_db_path = os.path.join(_addon_data, "cache.db")
+_playback_history_path = os.path.join(_addon_data, "cache.history")
+# Read-modify-write cycles on one path hold one of a fixed set of lock files
+# picked by its hash, so paths in other buckets aren't held up; cycles on data
+# shared by every path hold cache.lock
+_lock_path = os.path.join(_addon_data, "locks", "cache.lock")
+_bucket_lock = os.path.join(_addon_data, "locks", "cache-{}.lock")
+_lock_buckets = 64
+
+HISTORY_SIZE = 100
+# pages handed back to the filesystem per garbage collection
+_vacuum_pages = 2048
+
+_schema_version = 1
+_schema = [
+    "CREATE TABLE IF NOT EXISTS paths "
+    "(hash TEXT PRIMARY KEY, path TEXT, modified REAL NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS paths_modified ON paths (modified)",
+    "CREATE TABLE IF NOT EXISTS widgets "
+    "(hash TEXT NOT NULL, widget_id TEXT NOT NULL, PRIMARY KEY (hash, widget_id))",
+    "CREATE TABLE IF NOT EXISTS history "
+    "(hash TEXT NOT NULL, first_seen REAL NOT NULL, last_seen REAL NOT NULL, "
+    "content_hash TEXT, count INTEGER NOT NULL DEFAULT 1)",
+    "CREATE INDEX IF NOT EXISTS history_hash_seen ON history (hash, last_seen)",
+    "CREATE TABLE IF NOT EXISTS listings "
+    "(hash TEXT PRIMARY KEY, contents BLOB, updated REAL NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS plays (time REAL NOT NULL, media_type TEXT)",
+    "CREATE TABLE IF NOT EXISTS meta "
+    "(hash TEXT PRIMARY KEY, size INTEGER NOT NULL DEFAULT 0, content_hash TEXT, "
+    "fetched REAL NOT NULL DEFAULT 0, expiry REAL NOT NULL DEFAULT 0, "
+    "last_read REAL NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS plays_time ON plays (time)",
+]
+
+_meta_keys = ["size", "content_hash", "fetched", "expiry", "last_read"]
+
+_store = None
+_store_lock = threading.Lock()
+# bumped by `reopen`, so every process drops the store it has open
+_generation_property = "autowidget-store-generation"
+_generation = None
+
+
+def _lock_file(hash=None):
+    if hash is None:
+        return _lock_path
+    return _bucket_lock.format(int(hash[:4], 16) % _lock_buckets)
+
+
+def compact_history(history):
+    """Returns `history` as a list of `[first_seen, last_seen, content_hash,
+    count]` segments, one per run of identical content, keeping only the most
+    recent `HISTORY_SIZE` segments. Accepts the legacy `[time, content_hash]`
+    entries as well as segments."""
+    segments = []
+    for entry in history:
+        if len(entry) == 2:
+            entry = [entry[0], entry[0], entry[1], 1]
+        if segments and segments[-1][2] == entry[2]:
+            segments[-1][1] = entry[1]
+            segments[-1][3] += entry[3]
+        else:
+            segments.append(list(entry))
+    return segments[-HISTORY_SIZE:]
+
+
+def append_history(history, when, content_hash):
+    """Records a fetch at `when` in a compacted `history`, in place."""
+    if history and history[-1][2] == content_hash:
+        history[-1][1] = when
+        history[-1][3] += 1
+    else:
+        history.append([when, when, content_hash, 1])
+        del history[:-HISTORY_SIZE]
+    return history
+
+
+class JsonStore(object):
+    """Keeps one `.cache` and one `.history` file per path, plus a global
+    `cache.history` for playback records."""
+
+    name = "json"
+
+    def _history_path(self, hash):
+        return os.path.join(_addon_data, "{}.history".format(hash))
+
+    def _listing_path(self, hash):
+        return os.path.join(_addon_data, "{}.cache".format(hash))
+
+    def _meta_path(self, hash):
+        return os.path.join(_addon_data, "{}.meta".format(hash))
+
+    def lock(self, hash=None):
+        return utils.file_lock(_lock_file(hash))
+
+    def read_history(self, hash):
+        history_path = self._history_path(hash)
+        if not xbmcvfs.exists(history_path):
+            return None
+        cache_data = utils.read_json(
+            history_path, default=dict(history=[], widgets=[])
+        )
+        if cache_data.get("history"):
+            cache_data["history"] = compact_history(cache_data["history"])
+        return cache_data
+
+    def save_history(self, hash, cache_data, with_history=False):
+        utils.write_json(self._history_path(hash), cache_data)
+
+    def last_read(self, hash):
+        meta = self.read_meta(hash)
+        if meta is not None:
+            return meta.get("last_read", 0)
+        history_path = self._history_path(hash)
+        if not xbmcvfs.exists(history_path):
+            return 0
+        return xbmcvfs.Stat(history_path).st_mtime()
+
+    def histories(self, since=0):
+        for filename in xbmcvfs.listdir(_addon_data)[1]:
+            if not filename.endswith(".history") or filename == "cache.history":
+                continue
+            hash = os.path.splitext(filename)[0]
+            if self.last_read(hash) < since:
+                continue
+            yield hash, self.read_history(hash) or {}
+
+    def read_meta(self, hash):
+        meta_path = self._meta_path(hash)
+        if not xbmcvfs.exists(meta_path):
+            return None
+        return utils.read_json(meta_path, default=None)
+
+    def write_meta(self, hash, meta):
+        utils.write_json(self._meta_path(hash), meta, codec="json")
+
+    def listing_info(self, hash):
+        listing_path = self._listing_path(hash)
+        if not xbmcvfs.exists(listing_path):
+            return None
+        stat = xbmcvfs.Stat(listing_path)
+        return stat.st_mtime(), stat.st_size()
+
+    def read_listing(self, hash, log_file=False):
+        return utils.read_json(
+            self._listing_path(hash), log_file=log_file, default=None
+        )
+
+    def write_listing(self, hash, contents):
+        codec, level = listing_codec()
+        utils.write_json(self._listing_path(hash), contents, codec=codec, level=level)
+
+    def listing_hashes(self):
+        return [
+            os.path.splitext(filename)[0]
+            for filename in xbmcvfs.listdir(_addon_data)[1]
+            if filename.endswith(".cache")
+        ]
+
+    def remove_listing(self, hash):
+        utils.remove_file(self._listing_path(hash))
+        utils.remove_file(self._meta_path(hash))
+
+    def entries(self):
+        """Lists `(hash, last_read, size, widgets)` for everything cached,
+        including listings whose history has gone missing."""
+        entries = {}
+        for filename in xbmcvfs.listdir(_addon_data)[1]:
+            hash, ext = os.path.splitext(filename)
+            if ext not in [".cache", ".history", ".meta"]:
+                continue
+            if filename == "cache.history":
+                continue
+            stat = xbmcvfs.Stat(os.path.join(_addon_data, filename))
+            entry = entries.setdefault(hash, [hash, 0, 0, []])
+            entry[2] += stat.st_size()
+            if ext == ".history":
+                entry[1] = max(entry[1], self.last_read(hash))
+                entry[3] = (self.read_history(hash) or {}).get("widgets", [])
+        return [tuple(entry) for entry in entries.values()]
+
+    def remove(self, hash):
+        utils.remove_file(self._listing_path(hash))
+        utils.remove_file(self._meta_path(hash))
+        utils.remove_file(self._history_path(hash))
+
+    def remove_widgets(self, hash, widget_ids):
+        history_path = self._history_path(hash)
+        with self.lock(hash):
+            cache_data = self.read_history(hash)
+            if cache_data is None:
+                return
+            modified = xbmcvfs.Stat(history_path).st_mtime()
+            cache_data["widgets"] = [
+                i for i in cache_data.get("widgets", []) if i not in widget_ids
+            ]
+            self.save_history(hash, cache_data)
+            try:
+                # keep the time it was last read
+                os.utime(utils.translatePath(history_path), (modified, modified))
+            except OSError:
+                pass
+
+            meta = self.read_meta(hash)
+            if meta is not None:
+                meta["widgets"] = cache_data["widgets"]
+                self.write_meta(hash, meta)
+
+    def trim_plays(self, before):
+        with self.lock():
+            history = utils.read_json(_playback_history_path, default={})
+            plays = history.get("plays", [])
+            kept = [play for play in plays if play[0] >= before]
+            if len(kept) < len(plays):
+                history["plays"] = kept
+                utils.write_json(_playback_history_path, history)
+        return len(plays) - len(kept)
+
+    def compact(self):
+        pass
+
+    def read_plays(self):
+        return utils.read_json(_playback_history_path, default={}).get("plays", [])
+
+    def add_play(self, when, media_type):
+        with self.lock():
+            history = utils.read_json(_playback_history_path, default={})
+            history.setdefault("plays", []).append((when, media_type))
+            utils.write_json(_playback_history_path, history)
+
+    def import_files(self):
+        # the files are the store
+        pass
+
+    def export_files(self):
+        for filename in xbmcvfs.listdir(_addon_data)[1]:
+            if filename.endswith((".cache", ".history", ".meta")):
+                with xbmcvfs.File(os.path.join(_addon_data, filename)) as f:
+                    yield filename, bytes(f.readBytes())
+
+    def clear(self):
+        for file in xbmcvfs.listdir(_addon_data)[1]:
+            if file.endswith((".cache", ".history", ".meta")):
+                utils.remove_file(os.path.join(_addon_data, file))
+
+
+class SqliteStore(object):
+    """Keeps listings, history rows and playback records in a single
+    `cache.db`, with one connection per thread."""
+
+    name = "sqlite"
+
+    def __init__(self, path=_db_path):
+        self.path = path
+        self._local = threading.local()
+        self._setup()
+
+    def lock(self, hash=None):
+        # single statements are already serialised by BEGIN IMMEDIATE; this
+        # covers read-modify-write sequences spanning several of them
+        return utils.file_lock(_lock_file(hash))
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                utils.translatePath(self.path), timeout=30, isolation_level=None
+            )
+            # only takes effect on a new database, so it comes before WAL
+            # is turned on
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _setup(self):
+        migrated = []
+        with self._transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for statement in _schema:
+                conn.execute(statement)
+            if version < _schema_version:
+                migrated = self._migrate_files(conn)
+                conn.execute("PRAGMA user_version={:d}".format(_schema_version))
+
+        for path in migrated:
+            utils.remove_file(path)
+
+    def _migrate_files(self, conn):
+        """One-time import of the per-path JSON files into the database.
+        The files are removed once the transaction they were read in commits."""
+        migrated = []
+        for filename in xbmcvfs.listdir(_addon_data)[1]:
+            path = os.path.join(_addon_data, filename)
+            hash, ext = os.path.splitext(filename)
+            if filename == "cache.history":
+                plays = utils.read_json(path, default={}).get("plays", [])
+                # a restored backup may hold plays the database already has
+                conn.executemany(
+                    "INSERT INTO plays (time, media_type) SELECT ?, ? WHERE NOT EXISTS "
+                    "(SELECT 1 FROM plays WHERE time = ? AND media_type = ?)",
+                    [tuple(play) * 2 for play in plays],
+                )
+            elif ext == ".history":
+                cache_data = utils.read_json(path, default={})
+                cache_data["history"] = compact_history(cache_data.get("history", []))
+                self._write_history(
+                    conn,
+                    hash,
+                    cache_data,
+                    with_history=True,
+                    modified=xbmcvfs.Stat(path).st_mtime(),
+                )
+            elif ext == ".cache":
+                contents = utils.read_json(path, default=None)
+                if contents is not None:
+                    self._write_listing(conn, hash, contents)
+            else:
+                continue
+            migrated.append(path)
+
+        utils.log("Migrated {} cache files into {}".format(len(migrated), self.path))
+        return migrated
+
+    def import_files(self):
+        """Imports `.history` and `.cache` files put back by a restore, which
+        would otherwise sit unused next to the database."""
+        with self._transaction() as conn:
+            migrated = self._migrate_files(conn)
+        for path in migrated:
+            utils.remove_file(path)
+
+    def export_files(self):
+        """Yields `(filename, data)` for each path's history and listing, and
+        the playback records, as `JsonStore` would keep them on disk. Metadata
+        is left out; it's rebuilt the first time a listing is read."""
+        conn = self._connect()
+        for (hash,) in conn.execute("SELECT hash FROM paths").fetchall():
+            yield "{}.history".format(hash), utils.encode_json(self.read_history(hash))
+        for (hash,) in conn.execute("SELECT hash FROM listings").fetchall():
+            row = conn.execute(
+                "SELECT contents FROM listings WHERE hash = ?", (hash,)
+            ).fetchone()
+            if row is not None:
+                yield "{}.cache".format(hash), bytes(row[0])
+        plays = self.read_plays()
+        if plays:
+            yield "cache.history", utils.encode_json({"plays": plays})
+
+    def _write_segments(self, conn, hash, history):
+        conn.execute("DELETE FROM history WHERE hash = ?", (hash,))
+        conn.executemany(
+            "INSERT INTO history (hash, first_seen, last_seen, content_hash, count) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(hash,) + tuple(segment) for segment in history],
+        )
+
+    def _write_history(self, conn, hash, cache_data, with_history=False, modified=None):
+        conn.execute(
+            "INSERT OR REPLACE INTO paths (hash, path, modified) VALUES (?, ?, ?)",
+            (hash, cache_data.get("path"), modified or time.time()),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO widgets (hash, widget_id) VALUES (?, ?)",
+            [(hash, widget_id) for widget_id in cache_data.get("widgets", [])],
+        )
+        if with_history:
+            self._write_segments(conn, hash, cache_data.get("history", []))
+
+    def _write_listing(self, conn, hash, contents):
+        codec, level = listing_codec()
+        conn.execute(
+            "INSERT OR REPLACE INTO listings (hash, contents, updated) VALUES (?, ?, ?)",
+            (
+                hash,
+                sqlite3.Binary(utils.encode_json(contents, codec=codec, level=level)),
+                time.time(),
+            ),
+        )
+
+    def read_history(self, hash):
+        conn = self._connect()
+        row = conn.execute("SELECT path FROM paths WHERE hash = ?", (hash,)).fetchone()
+        if row is None:
+            return None
+        cache_data = {"path": row[0]} if row[0] is not None else {}
+        cache_data["history"] = [
+            list(segment)
+            for segment in conn.execute(
+                "SELECT first_seen, last_seen, content_hash, count FROM history "
+                "WHERE hash = ? ORDER BY last_seen",
+                (hash,),
+            )
+        ]
+        cache_data["widgets"] = [
+            widget_id
+            for (widget_id,) in conn.execute(
+                "SELECT widget_id FROM widgets WHERE hash = ? ORDER BY rowid", (hash,)
+            )
+        ]
+        return cache_data
+
+    def save_history(self, hash, cache_data, with_history=False):
+        with self._transaction() as conn:
+            self._write_history(conn, hash, cache_data, with_history)
+
+    def last_read(self, hash):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT COALESCE(m.last_read, p.modified) FROM paths p "
+                "LEFT JOIN meta m USING (hash) WHERE p.hash = ?",
+                (hash,),
+            )
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def histories(self, since=0):
+        hashes = [
+            hash
+            for (hash,) in self._connect().execute(
+                "SELECT p.hash FROM paths p LEFT JOIN meta m USING (hash) "
+                "WHERE COALESCE(m.last_read, p.modified) >= ?",
+                (since,),
+            )
+        ]
+        for hash in hashes:
+            yield hash, self.read_history(hash) or {}
+
+    def listing_info(self, hash):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT updated, length(contents) FROM listings WHERE hash = ?",
+                (hash,),
+            )
+            .fetchone()
+        )
+        return tuple(row) if row else None
+
+    def read_meta(self, hash):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT {} FROM meta WHERE hash = ?".format(", ".join(_meta_keys)),
+            (hash,),
+        ).fetchone()
+        if row is None:
+            return None
+        meta = dict(zip(_meta_keys, row))
+        meta["widgets"] = [
+            widget_id
+            for (widget_id,) in conn.execute(
+                "SELECT widget_id FROM widgets WHERE hash = ? ORDER BY rowid", (hash,)
+            )
+        ]
+        return meta
+
+    def write_meta(self, hash, meta):
+        # widgets are kept in their own table by save_history
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (hash, {}) VALUES (?{})".format(
+                    ", ".join(_meta_keys), ", ?" * len(_meta_keys)
+                ),
+                (hash,) + tuple(meta.get(key, 0) for key in _meta_keys),
+            )
+
+    def read_listing(self, hash, log_file=False):
+        row = (
+            self._connect()
+            .execute("SELECT contents FROM listings WHERE hash = ?", (hash,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        try:
+            return utils.convert(utils.decode_json(row[0]))
+        except (ValueError, TypeError, UnicodeDecodeError, IOError, zlib.error) as e:
+            utils.log("Could not read listing {}: {}".format(hash, e), "error")
+            if log_file:
+                utils.log(row[0], "info")
+            self.remove_listing(hash)
+            return None
+
+    def write_listing(self, hash, contents):
+        with self._transaction() as conn:
+            self._write_listing(conn, hash, contents)
+
+    def listing_hashes(self):
+        return [
+            hash for (hash,) in self._connect().execute("SELECT hash FROM listings")
+        ]
+
+    def remove_listing(self, hash):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM listings WHERE hash = ?", (hash,))
+            conn.execute("DELETE FROM meta WHERE hash = ?", (hash,))
+
+    def entries(self):
+        conn = self._connect()
+        widgets = {}
+        for hash, widget_id in conn.execute(
+            "SELECT hash, widget_id FROM widgets ORDER BY rowid"
+        ):
+            widgets.setdefault(hash, []).append(widget_id)
+        return [
+            (hash, last_read, size, widgets.get(hash, []))
+            for hash, last_read, size in conn.execute(
+                "SELECT hash, MAX(modified), SUM(size) FROM ("
+                "SELECT hash, modified, 0 AS size FROM paths UNION ALL "
+                "SELECT hash, last_read, 0 FROM meta UNION ALL "
+                "SELECT hash, 0, length(contents) FROM listings"
+                ") GROUP BY hash"
+            )
+        ]
+
+    def remove(self, hash):
+        with self._transaction() as conn:
+            for table in ["paths", "widgets", "history", "listings", "meta"]:
+                conn.execute("DELETE FROM {} WHERE hash = ?".format(table), (hash,))
+
+    def remove_widgets(self, hash, widget_ids):
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM widgets WHERE hash = ? AND widget_id = ?",
+                [(hash, widget_id) for widget_id in widget_ids],
+            )
+
+    def trim_plays(self, before):
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM plays WHERE time < ?", (before,)).rowcount
+
+    def compact(self):
+        # a slice of the free pages rather than VACUUM rewriting the whole
+        # file; execute would only step the pragma once, freeing one page
+        self._connect().executescript(
+            "PRAGMA incremental_vacuum({:d});".format(_vacuum_pages)
+        )
+
+    def read_plays(self):
+        return [
+            [when, media_type]
+            for when, media_type in self._connect().execute(
+                "SELECT time, media_type FROM plays ORDER BY time"
+            )
+        ]
+
+    def add_play(self, when, media_type):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO plays (time, media_type) VALUES (?, ?)",
+                (when, media_type),
+            )
+
+    def clear(self):
+        with self._transaction() as conn:
+            # plays too, as clearing the JSON store removes cache.history
+            for table in ["paths", "widgets", "history", "listings", "meta", "plays"]:
+                conn.execute("DELETE FROM {}".format(table))
+
+
+def listing_codec():
+    codec = settings.get_setting_int("cache.codec")
+    if not 0 <= codec < len(utils.json_codecs):
+        codec = 0
+    return utils.json_codecs[codec], settings.get_setting_int("cache.compression")
+
+
+def get_store():
+    global _store, _generation
+    with _store_lock:
+        if _store is None:
+            _generation = utils.get_property(_generation_property)
+            _store = _open_store()
+        return _store
+
+
+def reset():
+    global _store
+    with _store_lock:
+        _store = None
+
+
+def reopen():
+    """Tells every process to reopen its store, e.g. after a restore."""
+    utils.set_property(_generation_property, "{}".format(time.time()))
+    reset()
+
+
+def reopen_if_replaced():
+    if _store is not None and utils.get_property(_generation_property) != _generation:
+        reset()
+
+
+def _open_store():
+    if settings.get_setting_int("cache.backend") == 0:
+        if sqlite3 is None:
+            utils.log("sqlite3 is unavailable; using JSON cache files", "error")
+        else:
+            try:
+                return SqliteStore()
+            except sqlite3.Error as e:
+                utils.log(
+                    "Could not open {}, using JSON cache files: {}".format(_db_path, e),
+                    "error",
+                )
+    return JsonStore()
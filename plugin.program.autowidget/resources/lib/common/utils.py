@@ -2,18 +2,22 @@ import xbmc
 import xbmcgui
 import xbmcvfs
 
+import atexit
 import codecs
 import contextlib
+import gzip
 import io
 import json
 import os
 import string
+import threading
 import time
 import unicodedata
 import datetime
+import zlib
 
 import six
-from PIL import Image
+from six.moves import queue
 
 from resources.lib.common import settings
 
@@ -22,6 +26,16 @@ try:
 except ImportError:
     from urlparse import unquote
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 try:
     translatePath = xbmcvfs.translatePath
 except AttributeError:
@@ -34,6 +48,30 @@ _addon_root = translatePath(settings.get_addon_info("path"))
 _art_path = os.path.join(_addon_root, "resources", "media")
 _home = translatePath("special://home/")
 
+_json_header = b"AWJ:"
+json_codecs = ["json", "zlib", "gzip"]
+
+_held_locks = threading.local()
+
+_debug_log_path = os.path.join(_addon_data, "aw_debug.log")
+DEBUG_LOG_SIZE = 1048576
+# seconds the debug log writer waits for more lines before its thread exits
+DEBUG_LOG_IDLE = 1
+_debug_writer = None
+_debug_writer_lock = threading.Lock()
+_kodi_debug = [0, False]
+
+_art_manifests = {}
+
+try:
+    _log_levels = {"notice": xbmc.LOGNOTICE, "info": xbmc.LOGNOTICE}
+except AttributeError:
+    _log_levels = {"notice": xbmc.LOGINFO, "info": xbmc.LOGINFO}
+_log_levels.update(debug=xbmc.LOGDEBUG, error=xbmc.LOGERROR)
+
+_info_keys_path = os.path.join(_addon_data, "info_keys.json")
+_info_keys = None
+
 windows = {
     "programs": ["program", "script"],
     "addonbrowser": ["addon", "addons"],
@@ -223,30 +261,132 @@ def ft(seconds):
     return str(datetime.timedelta(seconds=int(seconds)))
 
 
-def log(msg, level="debug"):
-    _level = xbmc.LOGDEBUG
+def log(msg, level="debug", *args):
+    """Logs `msg`, formatted with `args` only once it's known the message will
+    be written. Debug messages are dropped before any formatting unless debug
+    logging is enabled here or in Kodi."""
     debug = settings.get_setting_bool("logging.debug")
-    logpath = os.path.join(_addon_data, "aw_debug.log")
-
-    if level == "debug":
-        _level = xbmc.LOGDEBUG
-    elif level in ["notice", "info"]:
-        try:
-            _level = xbmc.LOGNOTICE
-        except AttributeError:
-            _level = xbmc.LOGINFO
-    elif level == "error":
-        _level = xbmc.LOGERROR
+    if level == "debug" and not debug and not _kodi_debug_enabled():
+        return
 
-    msg = u"{}: {}".format(_addon_id, six.text_type(msg))
+    msg = six.text_type(msg)
+    if args:
+        msg = msg.format(*args)
+    msg = u"{}: {}".format(_addon_id, msg)
+    _level = _log_levels.get(level, xbmc.LOGDEBUG)
     try:
         xbmc.log(msg, _level)
     except UnicodeEncodeError:
         xbmc.log(msg.encode("utf-8"), _level)
     if debug:
-        debug_size = xbmcvfs.Stat(logpath).st_size() if xbmcvfs.exists(logpath) else 0
         debug_msg = u"{}  {}{}".format(time.ctime(), level.upper(), msg[25:])
-        write_file(logpath, debug_msg + "\n", mode="a" if debug_size < 1048576 else "w")
+        _get_debug_writer().write(debug_msg)
+
+
+def _kodi_debug_enabled():
+    # checked at most every 10s, as this is asked for every debug message
+    now = time.time()
+    if now - _kodi_debug[0] > 10:
+        _kodi_debug[:] = [now, get_condition("System.GetBool(debug.showloginfo)")]
+    return _kodi_debug[1]
+
+
+def _get_debug_writer():
+    global _debug_writer
+    with _debug_writer_lock:
+        if _debug_writer is None:
+            _debug_writer = DebugLogWriter(_debug_log_path)
+            atexit.register(_debug_writer.flush)
+        return _debug_writer
+
+
+def flush_log():
+    if _debug_writer is not None:
+        _debug_writer.flush()
+
+
+class DebugLogWriter(object):
+    """Appends lines to the debug log from a background thread, so callers
+    never wait on file I/O. `flush` stops the thread, as Kodi waits for it
+    before ending the invocation, and the next write starts another. Once the
+    log reaches `DEBUG_LOG_SIZE` it is moved to `<path>.1` and a new one
+    started."""
+
+    _stop = object()
+
+    def __init__(self, path, max_size=DEBUG_LOG_SIZE):
+        self.path = translatePath(path)
+        self.max_size = max_size
+        self._lines = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._thread = None
+
+    def write(self, line):
+        self._lines.put(line)
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="AutoWidget debug log"
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                lines = [self._lines.get(timeout=DEBUG_LOG_IDLE)]
+            except queue.Empty:
+                # also stop when idle, for callers that never flush
+                lines = [self._stop]
+            lines.extend(self._drain())
+            stop = self._stop in lines
+            if stop:
+                with self._thread_lock:
+                    self._thread = None
+                # lines written before that saw this thread running
+                lines.extend(self._drain())
+            lines = [line for line in lines if line is not self._stop]
+            if lines:
+                self._append(lines)
+            if stop:
+                return
+
+    def flush(self):
+        """Writes what's queued and waits for the thread to stop."""
+        with self._thread_lock:
+            thread = self._thread
+            if thread is not None:
+                self._lines.put(self._stop)
+        if thread is not None:
+            thread.join()
+        lines = [line for line in self._drain() if line is not self._stop]
+        if lines:
+            self._append(lines)
+
+    def _drain(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self._lines.get_nowait())
+            except queue.Empty:
+                return lines
+
+    def _append(self, lines):
+        with self._write_lock:
+            try:
+                if (
+                    os.path.exists(self.path)
+                    and os.path.getsize(self.path) >= self.max_size
+                ):
+                    _replace(self.path, self.path + ".1")
+                with io.open(self.path, "a", encoding="utf-8") as f:
+                    f.write(u"".join(line + u"\n" for line in lines))
+            except (IOError, OSError) as e:
+                xbmc.log(
+                    "{}: Could not write debug log: {}".format(_addon_id, e),
+                    xbmc.LOGERROR,
+                )
 
 
 def ensure_addon_data():
@@ -275,35 +415,101 @@ def wipe(folder=_addon_data, over=False):
 
 
 def get_art(filename, color=None):
-    art = {}
     if not color:
         color = settings.get_setting_string("ui.color")
 
-    themed_path = os.path.join(_addon_data, color)
-    if not xbmcvfs.exists(themed_path):
-        xbmcvfs.mkdirs(themed_path)
+    manifest = _load_art_manifest(color)
+    if manifest is not None:
+        return dict(manifest.get(filename, {}))
 
+    # no manifest for this colour yet, so find (and tint) this one by hand
+    art = {}
     for i in art_types:
         _i = i
         if i == "thumb":
             _i = "icon"
         path = os.path.join(_art_path, _i, "{}.png".format(filename))
-        new_path = ""
-
         if xbmcvfs.exists(path):
-            if color.lower() not in ["white", "#ffffff"]:
-                new_path = os.path.join(themed_path, "{}-{}.png".format(filename, _i))
-                if not xbmcvfs.exists(new_path):
-                    new_bytes = six.BytesIO()
-                    icon = Image.open(path).convert("RGBA")
-                    overlay = Image.new("RGBA", icon.size, color)
-                    Image.composite(overlay, icon, icon).save(new_bytes, format='png')
-                    write_file(new_path, new_bytes.getvalue())
-            art[i] = clean_artwork_url(new_path if xbmcvfs.exists(new_path) else path)
+            art[i] = clean_artwork_url(_themed_art(path, filename, _i, color))
 
     return art
 
 
+def _themed_art(path, filename, art_type, color):
+    if color.lower() in ["white", "#ffffff"]:
+        return path
+
+    themed_path = os.path.join(_addon_data, color)
+    new_path = os.path.join(themed_path, "{}-{}.png".format(filename, art_type))
+    if not xbmcvfs.exists(new_path):
+        if not xbmcvfs.exists(themed_path):
+            xbmcvfs.mkdirs(themed_path)
+        # only needed here, so keep it out of every plugin invocation
+        from PIL import Image
+
+        new_bytes = six.BytesIO()
+        icon = Image.open(path).convert("RGBA")
+        overlay = Image.new("RGBA", icon.size, color)
+        Image.composite(overlay, icon, icon).save(new_bytes, format='png')
+        write_file(new_path, new_bytes.getvalue())
+    return new_path if xbmcvfs.exists(new_path) else path
+
+
+def _art_manifest_path(color):
+    return os.path.join(_addon_data, color, "art.json")
+
+
+def _load_art_manifest(color):
+    manifest = _art_manifests.get(color)
+    if manifest is None:
+        manifest_path = _art_manifest_path(color)
+        if not xbmcvfs.exists(manifest_path):
+            return None
+        data = read_json(manifest_path, default={})
+        if data.get("version") != settings.get_addon_info("version"):
+            return None
+        manifest = _art_manifests[color] = data.get("art", {})
+    return manifest
+
+
+def ensure_art_manifest(color=None):
+    """Tints every icon for `color` in one batch and records where each piece
+    of art ended up, so that `get_art` becomes a lookup in a single file.
+    Does nothing if an up to date manifest already exists."""
+    if not color:
+        color = settings.get_setting_string("ui.color")
+    if _load_art_manifest(color) is not None:
+        return
+
+    with timing("Art manifest for {}".format(color)):
+        art = {}
+        for i in art_types:
+            _i = i
+            if i == "thumb":
+                _i = "icon"
+            folder = os.path.join(_art_path, _i)
+            if not xbmcvfs.exists(folder + os.sep):
+                continue
+            for name in xbmcvfs.listdir(folder + os.sep)[1]:
+                filename, ext = os.path.splitext(name)
+                if ext != ".png":
+                    continue
+                path = os.path.join(folder, name)
+                art.setdefault(filename, {})[i] = clean_artwork_url(
+                    _themed_art(path, filename, _i, color)
+                )
+
+        manifest_path = _art_manifest_path(color)
+        if not xbmcvfs.exists(os.path.dirname(manifest_path) + os.sep):
+            xbmcvfs.mkdirs(os.path.dirname(manifest_path))
+        write_json(
+            manifest_path,
+            {"version": settings.get_addon_info("version"), "art": art},
+            codec="json",
+        )
+        _art_manifests[color] = art
+
+
 def set_color(setting=False):
     dialog = xbmcgui.Dialog()
     color = settings.get_setting_string("ui.color")
@@ -449,37 +655,157 @@ def write_file(file, content, mode="w"):
     return False
 
 
+def encode_json(content, codec=None, level=6):
+    """Serializes `content` for writing to disk.
+
+    Without a codec this is the indented JSON used for groups and widgets.
+    Otherwise the JSON is compact, optionally compressed, and prefixed with a
+    header line naming the codec so `decode_json` knows how to read it back.
+    """
+    if codec is None:
+        return json.dumps(content, indent=4).encode("utf-8")
+
+    data = json.dumps(content, separators=(",", ":")).encode("utf-8")
+    if codec == "zlib":
+        data = zlib.compress(data, level)
+    elif codec == "gzip":
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb", compresslevel=level) as f:
+            f.write(data)
+        data = compressed.getvalue()
+    elif codec != "json":
+        raise ValueError("Unknown JSON codec: {}".format(codec))
+
+    return _json_header + codec.encode("utf-8") + b"\n" + data
+
+
+def decode_json(data):
+    """Reads JSON written by `encode_json`, as well as plain JSON files
+    written before the codec header existed."""
+    data = six.ensure_binary(data) if isinstance(data, six.text_type) else bytes(data)
+    if data.startswith(_json_header):
+        header, _, data = data.partition(b"\n")
+        codec = header[len(_json_header) :].decode("utf-8")
+        if codec == "zlib":
+            data = zlib.decompress(data)
+        elif codec == "gzip":
+            with gzip.GzipFile(fileobj=io.BytesIO(data), mode="rb") as f:
+                data = f.read()
+        elif codec != "json":
+            raise ValueError("Unknown JSON codec: {}".format(codec))
+
+    return json.loads(data.decode("utf-8"))
+
+
 def read_json(file, log_file=False, default={}):
     data = None
+    content = None
     # path = os.path.join(_addon_data, file) if _addon_data not in file else file
     path = translatePath(file)
     if not os.path.exists(path):
         log("{} does not exist.".format(file), level="error")
         return default
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return default
     with contextlib.closing(xbmcvfs.File(file, "r")) as f:
         try:
-            content = six.ensure_text(f.read())
-            data = json.loads(content)
-        except (ValueError, TypeError, UnicodeDecodeError, NameError, FileNotFoundError) as e:
+            content = f.readBytes()
+            data = decode_json(content)
+        except (
+            ValueError,
+            TypeError,
+            UnicodeDecodeError,
+            NameError,
+            IOError,
+            OSError,
+            EOFError,
+            zlib.error,
+        ) as e:
             log("Could not read JSON from {}: {}".format(file, e), level="error")
             if log_file:
                 log(content, level="info")
-            os.remove(path)
+            try:
+                # leave it alone if another process has replaced it meanwhile
+                if os.path.getmtime(path) == modified:
+                    os.remove(path)
+            except OSError:
+                pass
             return default
 
     return convert(data)
 
 
-def write_json(file, content):
-    with contextlib.closing(xbmcvfs.File(file, "w")) as f:
-        try:
-            f.write(bytearray(json.dumps(content, indent=4).encode('utf-8')))
-        except Exception as e:
-            log("Could not write to {}: {}".format(file, e), level="error")
-            return False
+def write_json(file, content, codec=None, level=6):
+    """Writes to a temporary file next to `file` and renames it into place,
+    so other processes only ever see the old or the new contents."""
+    path = translatePath(file)
+    temp = "{}.{}-{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(temp, "wb") as f:
+            f.write(encode_json(content, codec=codec, level=level))
+        _replace(temp, path)
+    except Exception as e:
+        log("Could not write to {}: {}".format(file, e), level="error")
+        if os.path.exists(temp):
+            os.remove(temp)
+        return False
     return True
 
 
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2 only renames over an existing file on POSIX
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.remove(dst)
+            os.rename(src, dst)
+
+
+@contextlib.contextmanager
+def file_lock(file):
+    """Holds an exclusive advisory lock on `file` against other processes
+    and threads. Re-entrant within a thread."""
+    path = translatePath(file)
+    held = _held_locks.__dict__.setdefault("paths", set())
+    if path in held:
+        yield
+        return
+
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # made by another process meanwhile
+            pass
+    with open(path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except (IOError, OSError):
+                    pass
+        held.add(path)
+        try:
+            yield
+        finally:
+            held.discard(path)
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
 def get_string(_id, kodi=False):
     if kodi:
         return six.text_type(xbmc.getLocalizedString(_id))
@@ -498,6 +824,21 @@ def clear_property(property, window=10000):
     xbmcgui.Window(window).clearProperty(property)
 
 
+def increment_counter(name, amount=1):
+    """Bumps a counter kept as a home window property, so it's shared
+    between the service and plugin invocations."""
+    value = get_counter(name) + amount
+    set_property("autowidget-stats-{}".format(name), "{}".format(value))
+    return value
+
+
+def get_counter(name):
+    try:
+        return int(get_property("autowidget-stats-{}".format(name)) or 0)
+    except ValueError:
+        return 0
+
+
 def get_infolabel(label):
     return xbmc.getInfoLabel(label)
 
@@ -520,6 +861,40 @@ def clean_artwork_url(url):
 
 
 def get_info_keys():
+    """Returns the `List.Fields.Files` enum, only introspecting JSON-RPC again
+    when the Kodi build or the JSON-RPC API version has changed."""
+    global _info_keys
+    if _info_keys is not None:
+        increment_counter("introspect-saved")
+        return _info_keys
+
+    version = _jsonrpc_versions()
+    cached = {}
+    if os.path.exists(translatePath(_info_keys_path)):
+        cached = read_json(_info_keys_path)
+    if cached.get("version") == version and cached.get("keys"):
+        increment_counter("introspect-saved")
+        _info_keys = cached["keys"]
+        return _info_keys
+
+    _info_keys = _introspect_info_keys()
+    write_json(_info_keys_path, {"version": version, "keys": _info_keys})
+    return _info_keys
+
+
+def _jsonrpc_versions():
+    api = call_jsonrpc({"jsonrpc": "2.0", "id": 1, "method": "JSONRPC.Version"})
+    api = api.get("result", {}).get("version", {})
+    return "{}/{}.{}.{}".format(
+        get_infolabel("System.BuildVersion"),
+        api.get("major"),
+        api.get("minor"),
+        api.get("patch"),
+    )
+
+
+def _introspect_info_keys():
+    increment_counter("introspect-calls")
     params = {
         "jsonrpc": "2.0",
         "id": 1,
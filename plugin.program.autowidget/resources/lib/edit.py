@@ -8,6 +8,7 @@ import six
 from resources.lib import manage
 from resources.lib.common import settings
 from resources.lib.common import utils
+from resources.lib.common.registry import registry
 
 _addon_data = settings.get_addon_info("profile")
 
@@ -96,6 +97,7 @@ def _remove_group(group_id, over=False):
     if over or choice:
         file = os.path.join(_addon_data, "{}.group".format(group_id))
         utils.remove_file(file)
+        registry.removed("{}.group".format(group_id))
         dialog.notification(
             "AutoWidget", utils.get_string(30029).format(six.text_type(group_name))
         )
@@ -130,6 +132,7 @@ def remove_widget(widget_id, over=False):
     if over or choice:
         file = os.path.join(_addon_data, "{}.widget".format(widget_id))
         utils.remove_file(file)
+        registry.removed("{}.widget".format(widget_id))
         dialog.notification("AutoWidget", utils.get_string(30029).format(widget_id))
     del dialog
 
@@ -3,78 +3,66 @@ import xbmcvfs
 
 import os
 import random
+import re
 
 from resources.lib.common import settings
 from resources.lib.common import utils
+from resources.lib.common.registry import registry
 
 _addon_data = settings.get_addon_info("profile")
 _userdata = "special://profile/"
 _skin_shortcuts = settings.get_addon_info("profile", addon="script.skinshortcuts")
+_schema_path = os.path.join(_addon_data, "schema.json")
 
+# skin file -> ((mtime, size), ids searched for, ids found)
+_skin_references = {}
 
-def clean(widget_id=None, notify=False, all=False):
+
+def clean(widget_id=None, notify=False, all=False, references=None):
     if all:
-        for widget in find_defined_widgets():
-            clean(widget_id=widget["id"])
+        widgets = find_defined_widgets()
+        references = find_skin_references([widget["id"] for widget in widgets])
+        for widget in widgets:
+            clean(widget_id=widget["id"], references=references)
         return find_defined_widgets()
 
-    files = []
     dialog = xbmcgui.Dialog()
-
-    params = {
-        "jsonrpc": "2.0",
-        "id": 1,
-        "method": "Addons.GetAddons",
-        "params": {"type": "xbmc.gui.skin"},
-    }
-    addons = utils.call_jsonrpc(params)
-    if "error" not in addons:
-        for addon in addons["result"]["addons"]:
-            path = os.path.join(
-                settings.get_addon_info("profile", addon=addon["addonid"]),
-                "settings.xml",
-            )
-            if xbmcvfs.exists(path):
-                files.append(path)
-    if _skin_shortcuts and xbmcvfs.exists(_skin_shortcuts):
-        for xml in xbmcvfs.listdir(_skin_shortcuts)[1]:
-            ext = xml.split(".")
-            if ext[-1] in ["xml", "properties"]:
-                path = os.path.join(_skin_shortcuts, xml)
-                files.append(path)
-
     removed = 0
 
     if widget_id:
-        found = False
-        for file in files:
-            if widget_id in utils.read_file(file):
-                found = True
-                utils.log("{} found in {}; not cleaning".format(widget_id, file))
-                break
-        if not found:
+        if references is None:
+            references = find_skin_references([widget_id])
+        if widget_id not in references:
             utils.log("{} not found; cleaning".format(widget_id))
             utils.remove_file(os.path.join(_addon_data, "{}.widget".format(widget_id)))
+            registry.removed("{}.widget".format(widget_id))
             del dialog
             return True
+        utils.log(
+            "{} found in {}; not cleaning".format(widget_id, references[widget_id])
+        )
         del dialog
         return False
 
-    for widget in find_defined_widgets():
-        found = False
-        if get_group_by_id(widget["group"]):
-            found = True
+    widgets = [
+        widget
+        for widget in find_defined_widgets()
+        if not get_group_by_id(widget["group"])
+    ]
+    references = find_skin_references([widget["id"] for widget in widgets])
+    for widget in widgets:
+        if widget["id"] in references:
+            utils.log(
+                "{} found in {}; not cleaning".format(
+                    widget["id"], references[widget["id"]]
+                )
+            )
         else:
-            for file in files:
-                if widget["id"] in utils.read_file(file):
-                    found = True
-                    utils.log("{} found in {}; not cleaning".format(widget["id"], file))
-                    break
-        if not found:
             utils.log("{} not found; cleaning".format(widget["id"]))
             utils.remove_file(
                 os.path.join(_addon_data, "{}.widget".format(widget["id"]))
             )
+            registry.removed("{}.widget".format(widget["id"]))
             removed += 1
     if notify:
         dialog.notification(
@@ -85,6 +73,69 @@ def clean(widget_id=None, notify=False, all=False):
     del dialog
 
 
+def _skin_files():
+    files = []
+    params = {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "Addons.GetAddons",
+        "params": {"type": "xbmc.gui.skin"},
+    }
+    addons = utils.call_jsonrpc(params)
+    if "error" not in addons:
+        for addon in addons["result"]["addons"]:
+            path = os.path.join(
+                settings.get_addon_info("profile", addon=addon["addonid"]),
+                "settings.xml",
+            )
+            if xbmcvfs.exists(path):
+                files.append(path)
+    if _skin_shortcuts and xbmcvfs.exists(_skin_shortcuts):
+        for xml in xbmcvfs.listdir(_skin_shortcuts)[1]:
+            ext = xml.split(".")
+            if ext[-1] in ["xml", "properties"]:
+                path = os.path.join(_skin_shortcuts, xml)
+                files.append(path)
+    return files
+
+
+def find_skin_references(widget_ids):
+    """Returns `{widget_id: file}` for each of `widget_ids` mentioned in a
+    skin's settings or a Skin Shortcuts file. Each file is read at most once
+    per call, searched for all ids with a single pattern, and not read again
+    while its mtime and size are unchanged and no new ids are asked about."""
+    widget_ids = set(widget_ids)
+    references = {}
+    if not widget_ids:
+        return references
+
+    for path in _skin_files():
+        stat = xbmcvfs.Stat(path)
+        key = (stat.st_mtime(), stat.st_size())
+        cached = _skin_references.get(path)
+        if cached is None or cached[0] != key or not widget_ids <= cached[1]:
+            searched = widget_ids
+            if cached is not None and cached[0] == key:
+                searched = widget_ids | cached[1]
+            # the lookahead lets matches overlap, and trying longer ids first
+            # means any id only found inside another is a substring of a match
+            pattern = re.compile(
+                "(?=({}))".format(
+                    "|".join(
+                        re.escape(i) for i in sorted(searched, key=len, reverse=True)
+                    )
+                )
+            )
+            found = set(pattern.findall(utils.read_file(path) or ""))
+            found.update(
+                [i for i in searched - found if any(i in match for match in found)]
+            )
+            cached = _skin_references[path] = (key, frozenset(searched), found)
+        for widget_id in cached[2] & widget_ids:
+            references.setdefault(widget_id, path)
+    return references
+
+
 def initialize(group_def, action, widget_id, save=True, keep=None):
     duration = settings.get_setting_float("service.refresh_duration")
     paths = group_def.get("paths", [])
@@ -140,13 +191,15 @@ def write_path(group_def, path_def=None, update=""):
             group_def["paths"].append(path_def)
 
     group_def["version"] = settings.get_addon_info("version")
-    utils.write_json(filename, group_def)
+    if utils.write_json(filename, group_def):
+        registry.saved(os.path.basename(filename), group_def)
 
 
 def save_path_details(params):
     path_to_saved = os.path.join(_addon_data, "{}.widget".format(params["id"]))
     params["version"] = settings.get_addon_info("version")
-    utils.write_json(path_to_saved, params)
+    if utils.write_json(path_to_saved, params):
+        registry.saved(os.path.basename(path_to_saved), params)
 
     return params
 
@@ -156,13 +209,14 @@ def get_group_by_id(group_id):
         return {}
 
     filename = "{}.group".format(group_id)
-    path = os.path.join(_addon_data, filename)
 
-    try:
-        group_def = utils.read_json(path)
-    except ValueError:
-        utils.log("Unable to parse: {}".format(path))
-        return
+    group_def = registry.get(filename)
+    if group_def is None:
+        utils.log(
+            "{} does not exist.".format(os.path.join(_addon_data, filename)),
+            level="error",
+        )
+        return {}
 
     return group_def
 
@@ -171,6 +225,9 @@ def get_path_by_id(path_id, group_id=None):
     if not path_id:
         return {}
 
+    if not group_id:
+        return registry.find_path(path_id)
+
     for defined in find_defined_paths(group_id):
         if defined.get("id", "") == path_id:
             return defined
@@ -180,9 +237,13 @@ def get_widget_by_id(widget_id, group_id=None):
     if not widget_id:
         return {}
 
-    for defined in find_defined_widgets(group_id):
-        if defined.get("id", "") == widget_id:
-            return defined
+    # widgets are always saved as <id>.widget
+    widget_def = registry.get("{}.widget".format(widget_id))
+    if not widget_def or widget_def.get("id", "") != widget_id:
+        return None
+    if group_id and widget_def.get("group") != group_id:
+        return None
+    return widget_def
 
 
 def highest_group_sort_order():
@@ -194,19 +255,14 @@ def find_defined_groups(_type=""):
     groups = []
     sort_order = 0
 
-    for filename in [
-        x for x in xbmcvfs.listdir(_addon_data)[1] if x.endswith(".group")
-    ]:
-        path = os.path.join(_addon_data, filename)
-
-        group_def = utils.read_json(path)
+    for filename, group_def in registry.definitions(".group"):
         if group_def:
+            # Older groups are fixed on disk by `migrate`; until then (e.g.
+            # straight after a restore) fill the gaps in without writing
             if not group_def.get("sort_order"):
                 group_def["sort_order"] = "{}".format(sort_order)
-                utils.write_json(path, group_def)
             if group_def.get("content") is None:
                 group_def["content"] = ""
-                utils.write_json(path, group_def)
 
             if _type:
                 if group_def["type"] == _type:
@@ -218,12 +274,50 @@ def find_defined_groups(_type=""):
     return sorted(groups, key=lambda x: int(x["sort_order"]))
 
 
+def _fill_group_defaults():
+    """Groups gained `sort_order` and `content`."""
+    for sort_order, (filename, group_def) in enumerate(
+        registry.definitions(".group")
+    ):
+        changed = False
+        if not group_def.get("sort_order"):
+            group_def["sort_order"] = "{}".format(sort_order)
+            changed = True
+        if group_def.get("content") is None:
+            group_def["content"] = ""
+            changed = True
+        if changed and utils.write_json(os.path.join(_addon_data, filename), group_def):
+            registry.saved(filename, group_def)
+            utils.log("Migrated {}".format(filename), "info")
+
+
+# Each step upgrades definitions by one schema version
+_migrations = [_fill_group_defaults]
+
+
+def migrate(force=False):
+    """Brings definitions written by older versions up to date, once. The
+    version reached is recorded in `schema.json`, so later starts skip the
+    steps already applied unless `force` is given (e.g. after a restore)."""
+    version = 0
+    if xbmcvfs.exists(_schema_path):
+        version = utils.read_json(_schema_path, default={}).get("version", 0)
+    if force:
+        version = 0
+    if version >= len(_migrations):
+        return
+
+    for step in _migrations[version:]:
+        step()
+    utils.write_json(_schema_path, {"version": len(_migrations)})
+    utils.log("Definitions migrated to version {}".format(len(_migrations)), "info")
+
+
 def find_defined_paths(group_id=None):
     if group_id:
         filename = "{}.group".format(group_id)
-        path = os.path.join(_addon_data, filename)
 
-        group_def = utils.read_json(path)
+        group_def = registry.get(filename)
         if group_def:
             return group_def.get("paths", [])
         else:
@@ -238,13 +332,9 @@ def find_defined_paths(group_id=None):
 
 
 def find_defined_widgets(group_id=None):
-    addon_files = xbmcvfs.listdir(_addon_data)[1]
     widgets = []
 
-    widget_files = [x for x in addon_files if x.endswith(".widget")]
-    for widget_file in widget_files:
-        widget_def = utils.read_json(os.path.join(_addon_data, widget_file))
-
+    for _, widget_def in registry.definitions(".widget"):
         if widget_def:
             if not group_id:
                 widgets.append(widget_def)
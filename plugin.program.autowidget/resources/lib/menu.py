@@ -279,6 +279,12 @@ def tools_menu():
         art=utils.get_art("cache"),
         isFolder=False,
     )
+    directory.add_menu_item(
+        title=30176,
+        params={"mode": "cache_report"},
+        art=utils.get_art("cache"),
+        isFolder=False,
+    )
 
     return True, utils.get_string(30008), None
 
@@ -310,7 +316,7 @@ def show_path(
     stack = widget_def.get("stack", [])
     path = widget_path["file"]["file"] if not stack else stack[-1]
 
-    utils.log("Loading items from {}".format(path), "debug")
+    utils.log("Loading items from {}", "debug", path)
     files, hash = refresh.get_files_list(path, path_label, widget_id)
 
     color = widget_path.get("color", default_color)
@@ -378,7 +384,7 @@ def show_path(
                 props=properties,
             )
             # Ensure we precache next page for faster access
-            cache.cache_expiry(file["file"], widget_id)
+            cache.cache_expiry(file["file"], widget_id, load=False)
         else:
             filetype = file.get("type", "")
             title = {
@@ -1,24 +1,54 @@
-import json
 import xbmc
 import xbmcgui
 import xbmcvfs
 
+import collections
+import heapq
+import itertools
 import os
 import random
 import time
 import threading
+import traceback
 import queue
 
 from resources.lib import manage
 from resources.lib.common import cache
 from resources.lib.common import settings
+from resources.lib.common import store
 from resources.lib.common import utils
 
 _addon_data = settings.get_addon_info("profile")
+_queue_path = os.path.join(_addon_data, "refresh.queue")
 
 skin_string_pattern = "autowidget-{}-{}"
 _properties = ["context.autowidget"]
 
+# Refresh priority classes, most urgent first: a holding tile is showing in
+# place of the listing, it's probably on screen, it has expired, or it may have
+# changed after playback
+_classes = ["foreground", "visible", "background", "speculative"]
+FOREGROUND, VISIBLE, BACKGROUND, SPECULATIVE = range(len(_classes))
+# a listing read this recently is assumed to still be on screen
+_visible_window = 10 * 60
+# paths read this recently are refreshed ahead of their predicted expiry, this
+# many seconds early
+_recent_window = 60 * 60
+_refresh_lead = 60
+# a path whose refresh failed is retried after `DEFAULT_CACHE_TIME`, doubling
+# with each failure in a row up to this many times
+_retry_max_doublings = 5
+# below this much free memory (MB) plugin fetches start to swap
+_low_memory = 500
+
+
+def _free_memory():
+    try:
+        return float(xbmc.getInfoLabel("System.FreeMemory").replace("MB", ""))
+    except ValueError:
+        return 0.0
+
+
 class RefreshService(xbmc.Monitor):
     def __init__(self):
         """Starts all of the actions of AutoWidget's service."""
@@ -26,21 +56,35 @@ class RefreshService(xbmc.Monitor):
         # Threads is IO bound more than CPU bound so would depend more disk
         # speed and RAM than anything else. how to pick a default value for that?
         # RAM is maybe biggest factor. low ram = more plugins at once = more swap on low disks
-        mem_used = float(xbmc.getInfoLabel('System.FreeMemory').replace("MB",""))
-        self.low_end = mem_used < 500
+        mem_used = _free_memory()
+        self.low_end = mem_used < _low_memory
         utils.log("+++++ STARTING AUTOWIDGET SERVICE Free Ram: {}, Low End: {} +++++".format(mem_used, self.low_end), "info")
 
         self.player = Player()
+        self.pool = WorkerPool(self._processQueue)
+        # widgets updated while video was playing, to show once it stops
+        self.deferred = set()
+        self._deferred_lock = threading.Lock()
+        self.hot_cache = cache.enable_hot_cache()
         utils.ensure_addon_data()
+        manage.migrate()
         self._update_properties()
         self._clean_widgets()
-        self.queue = OrderedSetQueue()
-        for _ in range(1 if self.low_end else 4):
-            thread = threading.Thread(target=self._processQueue)
-            thread.start()
+        self.queue = RefreshQueue()
+        self.restored = self.queue.load()
+        self.wheel = ExpiryWheel()
+        self.proactive = collections.deque()  # when each was queued, last hour
+        self.failures = {}  # hash -> refreshes in a row that failed
+        threading.Thread(target=self._collectRequests).start()
+        # the pool grows and shrinks from here as it sees how fetches go
+        self.pool.start(
+            self.pool.minimum if self.low_end else 4, delay=70 if self.low_end else 0
+        )
         self._update_widgets()
 
     def onSettingsChanged(self):
+        settings.invalidate()
+        store.reset()
         self._update_properties()
 
     def _update_properties(self):
@@ -63,12 +107,26 @@ class RefreshService(xbmc.Monitor):
             "service.refresh_notification"
         )
         self.refresh_sound = settings.get_setting_bool("service.refresh_sound")
+        self.refresh_budget = settings.get_setting_int("service.refresh_budget")
+        self.pool.limit(
+            settings.get_setting_int("service.workers_min"),
+            settings.get_setting_int("service.workers_max"),
+        )
+
+        # tint the icons for the current colour up front, off the UI's path
+        art_thread = threading.Thread(target=utils.ensure_art_manifest)
+        art_thread.daemon = True
+        art_thread.start()
 
         utils.update_container(True)
 
     def _clean_widgets(self):
-        for widget_def in manage.find_defined_widgets():
-            if not manage.clean(widget_def["id"]):
+        widget_defs = manage.find_defined_widgets()
+        references = manage.find_skin_references(
+            [widget_def["id"] for widget_def in widget_defs]
+        )
+        for widget_def in widget_defs:
+            if not manage.clean(widget_def["id"], references=references):
                 utils.log("Resetting {}".format(widget_def["id"]))
                 update_path(widget_def["id"], "reset")
 
@@ -88,41 +146,119 @@ class RefreshService(xbmc.Monitor):
 
         startup = True
         while not self.abortRequested():
+            try:
+                cache.collect_garbage()
+            except Exception:
+                # a damaged file or a busy database shouldn't stop refreshing
+                utils.log(traceback.format_exc(), "error")
             self._refresh(startup)
+            self._schedule_recent()
             startup = False
 
             utils.log("Time till refresh: {}s".format(60 * 60 * self.refresh_duration), "notice")
-            for _ in self.tick(step=5, max=60 * 60 * self.refresh_duration):
+            for waited in self.tick(step=5, max=60 * 60 * self.refresh_duration):
                 # don't process cache queue during video playback
                 if self.abortRequested():
                     break
+                # a restore may have rebuilt the cache underneath us
+                store.reopen_if_replaced()
+                self._refresh_due()
+                if waited % 10 == 0:
+                    # only count what a worker could take, or a backlog on
+                    # one busy add-on would keep adding idle workers
+                    self.pool.adjust(
+                        self.queue.qsize(),
+                        not self.player.idle.is_set(),
+                        _free_memory(),
+                    )
+                if waited % 60 == 0:
+                    # listings get read and fall overdue while they wait
+                    self.queue.reprioritise()
+                    self.player.sample()
+
+    def _schedule_expiry(self, hash, path, started=None):
+        meta = store.get_store().read_meta(hash)
+        if not (path and meta and meta.get("expiry")):
+            return
+        when = meta["expiry"] - _refresh_lead
+        if started is not None:
+            now = time.time()
+            if (meta.get("fetched") or 0) >= started and meta["expiry"] > now:
+                self.failures.pop(hash, None)
+            else:
+                # an error or empty listing leaves the expiry in the past, which
+                # would make it due again on the next tick
+                failures = self.failures[hash] = self.failures.get(hash, 0) + 1
+                delay = cache.DEFAULT_CACHE_TIME * 2 ** min(
+                    failures - 1, _retry_max_doublings
+                )
+                when = max(when, now + delay)
+        self.wheel.schedule(hash, path, when)
+
+    def _schedule_recent(self):
+        since = time.time() - _recent_window
+        for hash, cache_data in store.get_store().histories(since=since):
+            self._schedule_expiry(hash, cache_data.get("path"))
+
+    def _refresh_due(self):
+        """Queues recently read paths that are about to expire, so the next
+        read finds them fresh, spending at most `refresh_budget` an hour."""
+        now = time.time()
+        while self.proactive and self.proactive[0] < now - 60 * 60:
+            self.proactive.popleft()
+
+        for hash, path in self.wheel.due(now):
+            meta = store.get_store().read_meta(hash) or {}
+            if now - (meta.get("last_read") or 0) > _recent_window:
+                # nobody is looking; the next read will queue it if needed
+                continue
+            expiry = meta.get("expiry") or 0
+            if expiry - _refresh_lead > now + ExpiryWheel.slot:
+                # refreshed some other way since it was scheduled
+                self.wheel.schedule(hash, path, expiry - _refresh_lead)
+                continue
+            if len(self.proactive) >= self.refresh_budget:
+                utils.log("Refresh budget spent; {} left to expire", "debug", hash[:5])
+                continue
+            self.proactive.append(now)
+            utils.increment_counter("refresh-proactive")
+            self.queue.put((hash, path, None, "due", None))
 
 
-    def onNotification(self, sender, method, data):     
-        if sender == "AutoWidget":
-            data = json.loads(data)
-            utils.log("Added to queue: {} {} {}".format(*data), "notice")
-            # special queue ensures we don't queue same one twice at the same time
-            self.queue.put(tuple(data))
-            return True
+    def _collectRequests(self):
+        # picks up what plugin invocations spooled with `push_cache_queue`,
+        # including anything left from before the service started
+        while not self.abortRequested():
+            requests, taken = cache.take_cache_queue()
+            for request in requests:
+                utils.log("Added to queue ({3}): {0} {1} {2}", "notice", *request)
+                # special queue ensures we don't queue same one twice at the same time
+                self.queue.put(request)
+            # the spool is only let go once what it held is saved with the queue
+            if self.queue.save() and taken:
+                utils.remove_file(taken)
+            if self.waitForAbort(0.5):
+                break
+        self.queue.save()
 
 
-    def _processQueue(self):
-        if self.low_end:
-            self.waitForAbort(70)  # TODO: wait until no more added to queue?
+    def _processQueue(self, delay=0):
+        if delay:
+            self.waitForAbort(delay)  # TODO: wait until no more added to queue?
         utils.log("Starting processing queue", "notice")
 
         while not self.abortRequested():
-            if self.player.isPlayingVideo():
-                xbmc.sleep(1000)
+            if self.pool.retire():
+                return True
+            # don't process cache queue during video playback
+            if not self.player.idle.wait(5):
                 continue
+            self._apply_deferred()
             try:
-                hash, path, widget_id = self.queue.get(timeout=5)
+                hash, path, widget_id, reason = self.queue.get(timeout=5)
             except queue.Empty:
                 # TODO: first run of queue. first refresh now?
                 continue
-            history_path = os.path.join(_addon_data, "{}.history".format(hash))
-            cache_data = utils.read_json(history_path) if xbmcvfs.exists(history_path) else None
             # class Progress(object):
             #     dialog = None
             #     service = self
@@ -145,15 +281,34 @@ class RefreshService(xbmc.Monitor):
 
             # progress = Progress()
 
-            utils.log("Dequeued cache update: {} {}".format(hash[:5], path), "notice")
+            utils.log(
+                "Dequeued cache update ({}): {} {}".format(reason, hash[:5], path),
+                "notice",
+            )
 
-            affected_widgets = set(
-                cache.cache_and_update(
-                    path,
-                    widget_id,
-                    cache_data,  # notify=progress
+            started = time.time()
+            # everything touching the store is inside, so the path's slot is
+            # always given back
+            try:
+                cache_data = store.get_store().read_history(hash)
+                if widget_id is None and cache_data and cache_data["widgets"]:
+                    # queued on behalf of the path rather than a widget
+                    widget_id = cache_data["widgets"][0]
+                affected_widgets = set(
+                    cache.cache_and_update(
+                        path,
+                        widget_id,
+                        cache_data,  # notify=progress
+                    )
                 )
-            )
+                self._schedule_expiry(hash, path, started)
+            except Exception:
+                # one bad listing mustn't take the worker down with it
+                utils.log(traceback.format_exc(), "error")
+                continue
+            finally:
+                self.queue.finished(path, time.time() - started)
+            self.pool.record(time.time() - started)
             if affected_widgets:
                 updated = True
             # unrefreshed_widgets = unrefreshed_widgets.union(affected_widgets)
@@ -165,20 +320,29 @@ class RefreshService(xbmc.Monitor):
             # utils.log("paused queue until read {:.2} for {}".format(cache.last_read(hash)-before_update, hash[:5]), 'info')
             if self.abortRequested():
                 break
-            if self.player.isPlayingVideo():
-                # Video stop will cause another refresh anyway.
+            if not self.player.idle.is_set():
+                # keep them until playback stops, rather than redraw under it
+                with self._deferred_lock:
+                    self.deferred.update(affected_widgets)
                 continue
 
-            for widget_id in affected_widgets:
-                widget_def = manage.get_widget_by_id(widget_id)
-                if not widget_def:
-                    continue
-                _update_strings(widget_def)
-            if (
-                xbmcvfs.exists(os.path.join(_addon_data, "refresh.time"))
-                and utils.get_active_window() == "home"
-            ):
-                utils.update_container(True)
+            self._update_affected(affected_widgets)
+            utils.log("Hot cache: {}", "debug", self.hot_cache.stats())
+            utils.log("Refresh queue: {}", "debug", self.queue.stats())
+            utils.log(
+                "Reads: {} fresh, {} stale; {} refreshed early, {} fetches avoided",
+                "debug",
+                utils.get_counter("reads-fresh"),
+                utils.get_counter("reads-stale"),
+                utils.get_counter("refresh-proactive"),
+                utils.get_counter("fetches-avoided"),
+            )
+            utils.log(
+                "Info key introspection: {} calls, {} saved",
+                "debug",
+                utils.get_counter("introspect-calls"),
+                utils.get_counter("introspect-saved"),
+            )
             # # if progress.dialog is not None:
             # #     progress.dialog.update(100)
             # #     progress.dialog.close()
@@ -193,6 +357,27 @@ class RefreshService(xbmc.Monitor):
             #     )
         utils.log("Stop processing queue", "notice")
 
+    def _apply_deferred(self):
+        with self._deferred_lock:
+            widget_ids, self.deferred = self.deferred, set()
+        if widget_ids:
+            utils.log(
+                "Applying {} widget updates held during playback", "info", len(widget_ids)
+            )
+            self._update_affected(widget_ids)
+
+    def _update_affected(self, widget_ids):
+        for widget_id in widget_ids:
+            widget_def = manage.get_widget_by_id(widget_id)
+            if not widget_def:
+                continue
+            _update_strings(widget_def)
+        if (
+            xbmcvfs.exists(os.path.join(_addon_data, "refresh.time"))
+            and utils.get_active_window() == "home"
+        ):
+            utils.update_container(True)
+
 
     def _refresh(self, startup=False):
         if self.refresh_enabled in [0, 1] and manage.find_defined_widgets():
@@ -216,13 +401,14 @@ class RefreshService(xbmc.Monitor):
         else:
             utils.log("+++++ AUTOWIDGET REFRESHING NOT ENABLED +++++", "info")
 
-        if not startup:
+        if not startup or self.restored is not None:
+            # what was pending when the service stopped has been queued again
             return
         utils.log("+++++ AUTOWIDGET Refreshing widgets changed after playback in case of crash +++++", "info")
         # because update after playback could have been interupted. Do on startup too
-        for hash, path in cache.widgets_changed_by_watching(None):
+        for hash, path, chance in cache.widgets_changed_by_watching(None):
             # Queue them for refresh
-            cache.push_cache_queue(path)
+            cache.push_cache_queue(path, reason="playback", chance=chance)
             # utils.log("Queued cache update: {}".format(hash[:5]), "notice")
         # utils.update_container(reload=True)
 
@@ -380,9 +566,7 @@ def get_files_list(path, label=None, widget_id=None, background=True):
             utils.get_string(30137).format(label), "alert", hash=hash
         )
         files = error_tile.get("result", {}).get("files", [])
-        cache_path = os.path.join(_addon_data, "{}.cache".format(hash))
-        if xbmcvfs.exists(cache_path):
-            utils.remove_file(cache_path)
+        store.get_store().remove_listing(hash)
         utils.log("Invalid cache file removed for {}".format(hash))
 
     if not files:
@@ -431,9 +615,44 @@ class Player(xbmc.Player):
         super(Player, self).__init__()
         self.publish = None
         self.totalTime = -1
+        # position at the last playback event, counted on from `_anchor` at
+        # `_speed` while playing
         self.playingTime = 0
+        self._anchor = None
+        self._speed = 1.0
         self.info = {}
         self.path = None
+        # clear while video is playing (and not paused), for the queue workers
+        # to wait on
+        self.idle = threading.Event()
+        self._update_idle()
+
+    def _position(self):
+        if self._anchor is None:
+            return self.playingTime
+        return self.playingTime + (time.time() - self._anchor) * self._speed
+
+    def _track(self, position=None, playing=True):
+        """Re-anchors the tracked position at `position`, or wherever playback
+        has got to, and counts on from now unless `playing` is False."""
+        self.playingTime = self._position() if position is None else position
+        self._anchor = time.time() if playing else None
+
+    def sample(self):
+        """Corrects the tracked position from the player itself. The service
+        calls this about once a minute, which keeps drift small without a
+        thread waking up every second."""
+        try:
+            if self.isPlaying():
+                self._track(self.getTime(), playing=self._anchor is not None)
+        except RuntimeError:
+            pass
+
+    def _update_idle(self, paused=False):
+        if self.isPlayingVideo() and not paused:
+            self.idle.clear()
+        else:
+            self.idle.set()
 
     def playing_type(self):
         """
@@ -490,17 +709,14 @@ class Player(xbmc.Player):
         # self.recordPlay()
         self.type = self.playing_type()
         self.path = self.getPlayingFile()
-
-        def update_playback_time(self=self):
-            while self.isPlaying():
-                self.playingTime = self.getTime()
-                time.sleep(1)
-
-        threading.Thread(target=update_playback_time).start()
+        self._update_idle()
+        self._speed = 1.0
+        self._track(0)
 
     def onPlayBackEnded(self):
         # import ptvsd; ptvsd.enable_attach(address=('127.0.0.1', 5678)); ptvsd.wait_for_attach()
         utils.log("AutoWidget onPlayBackEnded callback", "notice")
+        self.idle.set()
 
         # Once a playback ends.
         # Work out which cached paths are most likely to change based on playback history
@@ -508,7 +724,9 @@ class Player(xbmc.Player):
         # Record playback in a history db so we can potentially use this for future predictions.
         try:
             tt = self.totalTime
-            tp = self.playingTime
+            tp = self._position()
+            if tt > 0:
+                tp = min(tp, tt)
             pp = int(100 * tp / tt)
         except RuntimeError:
             pp = -1
@@ -516,6 +734,7 @@ class Player(xbmc.Player):
             pp = -1
         self.totalTime = -1.0
         self.playingTime = 0.0
+        self._anchor = None
         self.info = {}
         cache.save_playback_history(self.type, pp, self.path)
         utils.log("recorded playback of {}% {}".format(pp, self.type), "notice")
@@ -524,9 +743,9 @@ class Player(xbmc.Player):
 
         # wait for a bit so scrobing can happen
         # time.sleep(5)
-        for hash, path in cache.widgets_changed_by_watching(self.type):
+        for hash, path, chance in cache.widgets_changed_by_watching(self.type):
             # Queue them for refresh
-            cache.push_cache_queue(path)
+            cache.push_cache_queue(path, reason="playback", chance=chance)
             # utils.log("Queued cache update: {}".format(hash[:5]), "notice")
         # utils.update_container(reload=True)
         utils.log("++ Finished queing widget updates after playback ++", "notice")
@@ -535,29 +754,398 @@ class Player(xbmc.Player):
         self.onPlayBackEnded()
 
     def onPlayBackSeek(self, time, seekOffset):
-        self.playingTime = time
+        # Kodi gives the time seeked to in milliseconds
+        self._track(time / 1000.0, playing=self._anchor is not None)
+
+    def onAVStarted(self):
+        # video isn't always known to be playing yet when playback starts, and
+        # nor is the position it resumed from
+        self._update_idle()
+        self.sample()
+
+    def onPlayBackError(self):
+        self.idle.set()
 
     def onPlayBackPaused(self):
-        pass
+        self._update_idle(paused=True)
+        self._track(playing=False)
 
     def onPlayBackResumed(self):
-        pass
+        self._update_idle()
+        self._track()
 
     def onPlayBackSeekChapter(self, chapter):
-        pass
+        self.sample()
 
     def onPlayBackSpeedChanged(self, speed):
-        pass
+        self._track(playing=self._anchor is not None)
+        self._speed = float(speed)
 
     def onQueueNextItem(self):
         pass
 
-class OrderedSetQueue(queue.Queue):
+class WorkerPool(object):
+    """Threads running `worker`, resized by `adjust` as fetches go."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.minimum = 1
+        self.maximum = 4
+        self.size = 0
+        self.target = 0
+        self.latency = None  # moving average of fetch time
+        self.best = None  # lowest that average has been
+        self.done = 0
+        self._lock = threading.Lock()
+        self._last = (time.time(), 0)
+
+    def limit(self, minimum, maximum):
+        with self._lock:
+            self.minimum = max(1, minimum)
+            self.maximum = max(self.minimum, maximum)
+            self.target = max(self.minimum, min(self.maximum, self.target))
+
+    def start(self, size, delay=0):
+        with self._lock:
+            self.target = max(self.minimum, min(self.maximum, size))
+        self._spawn(delay)
+
+    def _spawn(self, delay=0):
+        with self._lock:
+            count = self.target - self.size
+            self.size += max(count, 0)
+        for _ in range(count):
+            thread = threading.Thread(target=self._run, args=(delay,))
+            thread.start()
+
+    def _run(self, delay):
+        retired = False
+        try:
+            retired = self.worker(delay)
+        finally:
+            # `retire` already counted it out
+            if not retired:
+                with self._lock:
+                    self.size -= 1
+
+    def retire(self):
+        """Returns True if the calling worker should stop."""
+        with self._lock:
+            if self.size > self.target:
+                self.size -= 1
+                return True
+            return False
+
+    def record(self, seconds):
+        with self._lock:
+            self.done += 1
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency = 0.7 * self.latency + 0.3 * seconds
+            # creeps back up, so one quick plugin doesn't set the bar forever
+            self.best = min(self.latency, (self.best or seconds) * 1.02)
+
+    def _congested(self):
+        # fetches run much slower than they did with fewer workers
+        return self.latency is not None and self.latency > 2 * self.best
+
+    def adjust(self, depth, playing, free_memory):
+        """Resizes the pool for a queue `depth` long."""
+        with self._lock:
+            target = self.target
+            if playing or free_memory < _low_memory:
+                target = self.minimum
+            elif self._congested() or not depth:
+                target -= 1
+            elif depth > self.size:
+                target += 1
+            self.target = max(self.minimum, min(self.maximum, target))
+
+            now = time.time()
+            since, done = self._last
+            rate = (self.done - done) * 60 / max(now - since, 1)
+            self._last = (now, self.done)
+            changed = self.target != self.size
+        utils.log(
+            "Refresh workers: {} (want {}), {:.1f} fetches/min, {} fetch, {} queued",
+            "info" if changed else "debug",
+            self.size,
+            self.target,
+            rate,
+            "{:.1f}s".format(self.latency) if self.latency is not None else "no",
+            depth,
+        )
+        self._spawn()
+
+
+class ExpiryWheel(object):
+    """Paths waiting for a refresh time, bucketed into one minute slots so the
+    service can pick out what's due without looking at every path."""
+
+    slot = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}  # slot -> {hash: path}
+        self._scheduled = {}  # hash -> slot
+        self._cursor = int(time.time() // self.slot)
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, hash, path, when):
+        """Sets (or moves) the time `hash` is due. Times already past are due
+        at the next call to `due`."""
+        with self._lock:
+            self._unschedule(hash)
+            slot = max(int(when // self.slot), self._cursor)
+            self._slots.setdefault(slot, {})[hash] = path
+            self._scheduled[hash] = slot
+
+    def _unschedule(self, hash):
+        slot = self._scheduled.pop(hash, None)
+        if slot is not None:
+            del self._slots[slot][hash]
+            if not self._slots[slot]:
+                del self._slots[slot]
+
+    def due(self, now):
+        """Removes and returns `(hash, path)` for everything due by `now`."""
+        last = int(now // self.slot)
+        due = []
+        with self._lock:
+            while self._cursor <= last:
+                for hash, path in self._slots.pop(self._cursor, {}).items():
+                    del self._scheduled[hash]
+                    due.append((hash, path))
+                self._cursor += 1
+        return due
+
+
+def _refresh_priority(hash, reason, chance=None):
+    """Returns a sortable priority for refreshing `hash`, lowest first."""
+    now = time.time()
+    meta = store.get_store().read_meta(hash) or {}
+    # within a class the most likely to have changed, or most overdue, go first
+    if reason == "playback":
+        return SPECULATIVE, -(chance or 0)
+
+    overdue = now - (meta.get("expiry") or now)
+    if reason == "missing":
+        return FOREGROUND, -overdue
+    elif reason == "precache":
+        # read ahead of being shown, so `last_read` doesn't mean it's visible
+        return BACKGROUND, -overdue
+    elif now - (meta.get("last_read") or 0) < _visible_window:
+        return VISIBLE, -overdue
+    return BACKGROUND, -overdue
+
+
+def _source(path):
+    """Returns the add-on id a `plugin://` path is served by, or "local" for
+    paths Kodi answers itself (`videodb://`, `library://` and the like)."""
+    scheme, _, rest = (path or "").partition("://")
+    if scheme == "plugin" and rest:
+        return rest.split("/", 1)[0].split("?", 1)[0]
+    return "local"
+
+
+class RefreshQueue(queue.Queue):
+    """Cache updates waiting for a worker, most urgent first. Items are
+    `(hash, path, widget_id, reason, chance)` as sent by `push_cache_queue`,
+    and `get` returns `(hash, path, widget_id, reason)`. Workers call
+    `finished` with the path once they're done with it."""
+
+    # paths of one add-on fetched at once, so its widgets can't tie up every
+    # worker and its invoker; local paths aren't limited
+    per_addon = 2
+
     def _init(self, maxsize):
-        self.queue = {}  # Python 3 dict is ordered
+        # source -> heap of [priority, seq, hash], replaced entries have no hash
+        self.heaps = {}
+        # hash -> [heap entry, path, widget_id, reason, chance, time queued]
+        self.requests = {}
+        self.seq = itertools.count()
+        self.in_flight = collections.Counter()
+        # hash -> [hash, path, widget_id, reason, chance, time queued] for what
+        # workers are fetching
+        self.fetching = {}
+        self.dirty = False
+        self.served = {}  # source -> seq when last dequeued from
+        # class or source -> [count, total seconds, longest]
+        self.waits = dict((name, [0, 0.0, 0.0]) for name in _classes)
+        self.fetches = {}
+
+    def _ready(self, source):
+        return source == "local" or self.in_flight[source] < self.per_addon
+
+    def _head(self, source):
+        heap = self.heaps[source]
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _qsize(self):
+        # only what a worker could take right now, so `get` waits for a free
+        # slot rather than for any item
+        return sum(
+            1
+            for request in self.requests.values()
+            if self._ready(_source(request[1]))
+        )
+
+    def _push(self, hash, path, priority):
+        entry = [priority, next(self.seq), hash]
+        heapq.heappush(self.heaps.setdefault(_source(path), []), entry)
+        return entry
+
+    def put(self, item, block=True, timeout=None):
+        # ranked before taking the mutex, as it reads metadata
+        hash, _, _, reason, chance = item[:5]
+        priority = _refresh_priority(hash, reason, chance)
+        queue.Queue.put(self, (priority, item), block, timeout)
+
     def _put(self, item):
-        self.queue[item] = None
+        priority, item = item
+        hash, path, widget_id, reason, chance = item[:5]
+        # only requests restored by `load` come with the time they were queued
+        queued = item[5] if len(item) > 5 else time.time()
+        if hash in self.fetching:
+            # the fetch under way will answer it, and `push_cache_queue` has
+            # already recorded the widget id
+            utils.increment_counter("fetches-avoided")
+            return
+        request = self.requests.get(hash)
+        self.dirty = True
+        if request is None:
+            self.requests[hash] = [
+                self._push(hash, path, priority),
+                path,
+                widget_id,
+                reason,
+                chance,
+                queued,
+            ]
+            return
+
+        # a path is only queued once; asking again can only raise its priority
+        if request[2] is None:
+            request[2] = widget_id
+        if priority < request[0][0]:
+            request[0][2] = None
+            request[0] = self._push(hash, request[1], priority)
+            request[3:5] = reason, chance
+
     def _get(self):
-        val = next(iter(self.queue.keys()))
-        del self.queue[val]
-        return val
\ No newline at end of file
+        heads = []
+        for source in list(self.heaps):
+            head = self._head(source)
+            if head is None:
+                del self.heaps[source]
+            elif self._ready(source):
+                # best class first, then add-ons take turns, whoever has
+                # waited longest first
+                turn = self.served.get(source, -1)
+                heads.append(((head[0][0], turn, head[0], head[1]), source))
+        source = min(heads)[1]
+        priority, _, hash = heapq.heappop(self.heaps[source])
+        request = self.requests.pop(hash)
+        _, path, widget_id, reason, _, queued = request
+        self.served[source] = next(self.seq)
+        self.in_flight[source] += 1
+        self.fetching[hash] = [hash] + request[1:]
+        self.dirty = True
+
+        self._record(self.waits[_classes[priority[0]]], time.time() - queued)
+        return hash, path, widget_id, reason
+
+    def _record(self, stats, seconds):
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def finished(self, path, seconds):
+        """Frees the slot `path` held and records that it took `seconds`."""
+        source = _source(path)
+        with self.not_empty:
+            self.in_flight[source] -= 1
+            self.fetching.pop(cache.path2hash(path), None)
+            self.dirty = True
+            self._record(self.fetches.setdefault(source, [0, 0.0, 0.0]), seconds)
+            self.not_empty.notify()
+
+    def save(self):
+        """Saves what's queued or being fetched if it changed; False if that failed."""
+        with self.mutex:
+            if not self.dirty:
+                return True
+            self.dirty = False
+            pending = list(self.fetching.values()) + [
+                [hash] + request[1:] for hash, request in self.requests.items()
+            ]
+        if not utils.write_json(_queue_path, pending):
+            with self.mutex:
+                self.dirty = True
+            return False
+        return True
+
+    def load(self):
+        """Queues what was pending when the service last stopped, apart from
+        paths fetched since. Returns how many were queued, or None if there
+        was nothing saved."""
+        if not xbmcvfs.exists(_queue_path):
+            return None
+        pending = utils.read_json(_queue_path, default=[]) or []
+        _store = store.get_store()
+        restored = 0
+        for hash, path, widget_id, reason, chance, queued in pending:
+            meta = _store.read_meta(hash) or {}
+            if (meta.get("fetched") or 0) > queued:
+                continue
+            self.put((hash, path, widget_id, reason, chance, queued))
+            restored += 1
+        utils.log("Restored {} of {} pending refreshes", "info", restored, len(pending))
+        return restored
+
+    def reprioritise(self):
+        """Recomputes the priority of everything queued."""
+        with self.mutex:
+            queued = [
+                (hash, request[3], request[4])
+                for hash, request in self.requests.items()
+            ]
+        priorities = [
+            (hash, _refresh_priority(hash, reason, chance))
+            for hash, reason, chance in queued
+        ]
+        with self.mutex:
+            for hash, priority in priorities:
+                request = self.requests.get(hash)
+                if request is not None:
+                    request[0][0] = priority
+            # rebuilding drops stale entries too
+            self.heaps = {}
+            for request in self.requests.values():
+                self.heaps.setdefault(_source(request[1]), []).append(request[0])
+            for heap in self.heaps.values():
+                heapq.heapify(heap)
+
+    def stats(self):
+        """Summarises how long dequeued updates waited, by class, and how
+        long each add-on took to fetch them."""
+
+        def summary(stats, names):
+            return ", ".join(
+                "{} {} (avg {:.1f}s, max {:.1f}s)".format(
+                    name, count, total / count, longest
+                )
+                for name, (count, total, longest) in ((n, stats[n]) for n in names)
+                if count
+            )
+
+        with self.mutex:
+            return "waited {}; fetched {}".format(
+                summary(self.waits, _classes) or "nothing",
+                summary(self.fetches, sorted(self.fetches)) or "nothing",
+            )
\ No newline at end of file
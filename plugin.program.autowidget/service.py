@@ -1,5 +1,7 @@
 from resources.lib import refresh
+from resources.lib.common import utils
 
 if __name__ == "__main__":
     _monitor = refresh.RefreshService()
     _monitor.waitForAbort()
+    utils.flush_log()
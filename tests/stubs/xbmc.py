@@ -0,0 +1,59 @@
+"""Just enough of Kodi's xbmc module to import and run the add-on."""
+import json
+import time
+
+LOGDEBUG, LOGINFO, LOGNOTICE, LOGWARNING, LOGERROR = 0, 1, 2, 3, 4
+
+
+def log(msg, level=LOGDEBUG):
+    pass
+
+
+def sleep(ms):
+    time.sleep(ms / 1000.0)
+
+
+def getInfoLabel(label):
+    return {"System.FreeMemory": "1000MB", "System.BuildVersion": "19.1"}.get(
+        label, ""
+    )
+
+
+def getCondVisibility(condition):
+    return False
+
+
+def executebuiltin(function, wait=False):
+    pass
+
+
+def executeJSONRPC(call):
+    return json.dumps({"result": {}})
+
+
+class Monitor(object):
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=None):
+        return False
+
+
+class Player(object):
+    def isPlaying(self):
+        return False
+
+    def isPlayingVideo(self):
+        return False
+
+    def isPlayingAudio(self):
+        return False
+
+    def getTime(self):
+        return 0.0
+
+    def getTotalTime(self):
+        return 0.0
+
+    def getPlayingFile(self):
+        return ""
@@ -0,0 +1,50 @@
+import os
+
+# settings by id, as strings like Kodi keeps them; tests change these directly
+SETTINGS = {}
+
+
+class Addon(object):
+    def __init__(self, id=None):
+        self.id = id
+
+    def getAddonInfo(self, info):
+        return {
+            "id": "plugin.program.autowidget",
+            "profile": os.environ["AUTOWIDGET_PROFILE"],
+            "path": os.environ["AUTOWIDGET_PATH"],
+            "version": "0.0.0",
+        }.get(info, "")
+
+    def getLocalizedString(self, id):
+        return "{}".format(id)
+
+    def getSetting(self, id):
+        return SETTINGS.get(id, "")
+
+    def getSettingBool(self, id):
+        return SETTINGS.get(id) == "true"
+
+    def getSettingInt(self, id):
+        return int(SETTINGS.get(id) or 0)
+
+    def getSettingNumber(self, id):
+        return float(SETTINGS.get(id) or 0)
+
+    def getSettingString(self, id):
+        return SETTINGS.get(id, "")
+
+    def setSetting(self, id, value):
+        SETTINGS[id] = "{}".format(value)
+
+    def setSettingBool(self, id, value):
+        SETTINGS[id] = "true" if value else "false"
+        return True
+
+    def setSettingInt(self, id, value):
+        SETTINGS[id] = "{}".format(value)
+        return True
+
+    def setSettingString(self, id, value):
+        SETTINGS[id] = value
+        return True
@@ -0,0 +1,36 @@
+_properties = {}
+
+
+class Window(object):
+    def __init__(self, id=None):
+        pass
+
+    def getProperty(self, key):
+        return _properties.get(key.lower(), "")
+
+    def setProperty(self, key, value):
+        _properties[key.lower()] = value
+
+    def clearProperty(self, key):
+        _properties.pop(key.lower(), None)
+
+
+class Dialog(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class DialogProgress(Dialog):
+    pass
+
+
+class DialogProgressBG(Dialog):
+    pass
+
+
+class ListItem(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
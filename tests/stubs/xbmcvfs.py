@@ -0,0 +1,81 @@
+import io
+import os
+import shutil
+
+
+def translatePath(path):
+    return path
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def mkdirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return True
+
+
+def delete(path):
+    os.remove(path)
+    return True
+
+
+def rmdir(path, force=False):
+    shutil.rmtree(path) if force else os.rmdir(path)
+    return True
+
+
+def rename(src, dst):
+    os.rename(src, dst)
+    return True
+
+
+def copy(src, dst):
+    shutil.copy(src, dst)
+    return True
+
+
+def listdir(path):
+    dirs, files = [], []
+    for name in os.listdir(path):
+        (dirs if os.path.isdir(os.path.join(path, name)) else files).append(name)
+    return dirs, files
+
+
+class Stat(object):
+    def __init__(self, path):
+        self._stat = os.stat(path)
+
+    def st_mtime(self):
+        return self._stat.st_mtime
+
+    def st_size(self):
+        return self._stat.st_size
+
+
+class File(object):
+    def __init__(self, path, mode="r"):
+        self._file = io.open(path, {"r": "rb", "w": "wb", "a": "ab"}[mode])
+
+    def read(self):
+        return self._file.read().decode("utf-8")
+
+    def readBytes(self):
+        return bytearray(self._file.read())
+
+    def write(self, content):
+        if not isinstance(content, (bytes, bytearray)):
+            content = content.encode("utf-8")
+        self._file.write(bytes(content))
+        return True
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
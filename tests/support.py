@@ -0,0 +1,25 @@
+"""Lets tests import the add-on against the stubbed Kodi modules in `stubs`,
+with a throwaway profile folder. Import it before anything from `resources`.
+
+Run with `python -m unittest discover -s tests` from the repository root."""
+import os
+import shutil
+import sys
+import tempfile
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_addon = os.path.join(os.path.dirname(_here), "plugin.program.autowidget")
+sys.path[:0] = [os.path.join(_here, "stubs"), _addon]
+
+# child processes inherit the profile, so they share the parent's cache
+if "AUTOWIDGET_PROFILE" not in os.environ:
+    os.environ["AUTOWIDGET_PROFILE"] = tempfile.mkdtemp(prefix="autowidget-") + os.sep
+    os.environ["AUTOWIDGET_PATH"] = _addon + os.sep
+    _owner = os.getpid()
+
+    import atexit
+
+    @atexit.register
+    def _remove_profile():
+        if os.getpid() == _owner:
+            shutil.rmtree(os.environ["AUTOWIDGET_PROFILE"], ignore_errors=True)
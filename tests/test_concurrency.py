@@ -0,0 +1,73 @@
+"""Processes reading and refreshing one path at once, the way plugin
+invocations and the service do."""
+import multiprocessing
+import unittest
+
+import support  # noqa: F401
+
+import xbmcaddon
+
+from resources.lib.common import cache
+from resources.lib.common import settings
+from resources.lib.common import store
+
+PATH = "plugin://plugin.video.example/?list=1"
+PROCESSES = 8
+CALLS = 40
+
+
+def _use_backend(backend):
+    xbmcaddon.SETTINGS["cache.backend"] = backend
+    settings.invalidate()
+    store.reset()
+
+
+def _read_and_refresh(args):
+    """Registers a widget per call, rewriting the listing every fifth call.
+    Returns how many reads fell back to a holding tile."""
+    backend, process = args
+    _use_backend(backend)
+    holding = 0
+    for call in range(CALLS):
+        widget_id = "w{}-{}".format(process, call)
+        if call % 5 == 0:
+            listing = {"result": {"files": [process, call]}}
+            cache.cache_expiry(PATH, widget_id, add=listing)
+        else:
+            contents = cache.cache_expiry(PATH, widget_id)[1]
+            if isinstance(contents["result"]["files"][0], dict):
+                holding += 1
+    return holding
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def _check(self, backend):
+        _use_backend(backend)
+        cache.cache_expiry(PATH, "seed", add={"result": {"files": ["seed"]}})
+        pool = multiprocessing.Pool(PROCESSES)
+        try:
+            holding = sum(
+                pool.map(_read_and_refresh, [(backend, n) for n in range(PROCESSES)])
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+        store.reset()
+        _store = store.get_store()
+        cache_data = _store.read_history(cache.path2hash(PATH))
+        try:
+            self.assertEqual(len(cache_data["widgets"]), PROCESSES * CALLS + 1)
+            self.assertEqual(holding, 0)
+        finally:
+            _store.clear()
+
+    def test_sqlite(self):
+        self._check("0")
+
+    def test_json(self):
+        self._check("1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Random playback sessions against `refresh.Player`, checking the watched
+percentage it records against where playback really got to."""
+import random
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import support  # noqa: F401
+
+from resources.lib import refresh
+from resources.lib.common import cache
+
+SESSIONS = 500
+
+
+class SimulatedPlayer(refresh.Player):
+    """Answers the player calls from a simulated timeline instead of Kodi."""
+
+    def __init__(self, clock, total):
+        self.clock = clock
+        self.total = total
+        self.position = 0.0
+        self.speed = 1.0
+        self.paused = False
+        self.playing = True
+        super(SimulatedPlayer, self).__init__()
+
+    def advance(self, seconds, stalled=False):
+        if not (self.paused or stalled):
+            self.position += seconds * self.speed
+            self.position = max(0.0, min(self.total, self.position))
+        self.clock[0] += seconds
+
+    def isPlaying(self):
+        return self.playing
+
+    def isPlayingVideo(self):
+        return self.playing and not self.paused
+
+    def isPlayingAudio(self):
+        return False
+
+    def getTime(self):
+        return self.position
+
+    def getTotalTime(self):
+        return self.total
+
+    def getPlayingFile(self):
+        return "/videos/example.mkv"
+
+
+class PlayerTest(unittest.TestCase):
+    def _simulate(self, stall_chance):
+        """Plays `SESSIONS` sessions mixing pauses, seeks, speed changes and
+        the service's once a minute samples, with a buffering stall (time
+        passing with no progress and no event) at `stall_chance` of steps.
+        Returns the difference in recorded percentage for each."""
+        rng = random.Random(1)
+        clock = [1000.0]
+        recorded = []
+        differences = []
+        with mock.patch("time.time", lambda: clock[0]), mock.patch.object(
+            cache, "save_playback_history", lambda t, pp, path: recorded.append(pp)
+        ), mock.patch.object(cache, "widgets_changed_by_watching", lambda t: []):
+            for _ in range(SESSIONS):
+                player = SimulatedPlayer(clock, rng.choice([1320.0, 2700.0, 6000.0]))
+                player.onPlayBackStarted()
+                player.onAVStarted()
+                since_sample = 0
+                while True:
+                    step = rng.uniform(1, 40)
+                    player.advance(step)
+                    since_sample += step
+                    if rng.random() < stall_chance:
+                        stall = rng.uniform(1, 30)
+                        player.advance(stall, stalled=True)
+                        since_sample += stall
+                    if since_sample >= 60:
+                        player.sample()
+                        since_sample = 0
+                    if player.position >= player.total or rng.random() < 0.01:
+                        break
+                    event = rng.random()
+                    if event < 0.2:
+                        player.paused = not player.paused
+                        if player.paused:
+                            player.onPlayBackPaused()
+                        else:
+                            player.onPlayBackResumed()
+                    elif event < 0.4:
+                        player.position = rng.uniform(0, player.total)
+                        player.onPlayBackSeek(int(player.position * 1000), 0)
+                    elif event < 0.5:
+                        player.speed = rng.choice([1.0, 2.0, 4.0, 1.0])
+                        player.onPlayBackSpeedChanged(player.speed)
+                truth = int(100 * player.position / player.total)
+                player.playing = False
+                player.onPlayBackEnded()
+                differences.append(abs(recorded[-1] - truth))
+        return differences
+
+    def test_events_only(self):
+        self.assertEqual(max(self._simulate(stall_chance=0)), 0)
+
+    def test_buffering_stalls(self):
+        differences = self._simulate(stall_chance=0.1)
+        self.assertLess(sum(differences) / float(len(differences)), 0.1)
+        self.assertLessEqual(max(differences), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()